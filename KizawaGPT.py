@@ -1,53 +1,1900 @@
+import time
+STARTUP_STARTED = time.perf_counter()
 import tkinter as tk
 from tkinter import scrolledtext, ttk, filedialog
-from openai import AzureOpenAI
 import json
 import os
 import datetime
 import threading
 import re
 import subprocess
+import sys
+import queue
+import asyncio
+import sqlite3
+import hashlib
+import struct
+import argparse
+import random
+import email.utils
+import tempfile
+import itertools
+import collections
+
+# The openai SDK (httpx, pydantic) takes most of the startup time, so it is imported on first use
+openai = None
+
+def import_openai():
+    global openai
+    if openai is None:
+        import openai as module
+        openai = module
+    return openai
+
+DEFAULT_SETTINGS = {
+    "AZURE_OPENAI_KEY": "your_default_key",
+    "AZURE_OPENAI_ENDPOINT": "your_default_endpoint",
+    "DEPLOYMENT_NAME": "your_default_deployment_name",
+    "MAX_TOKENS": 2000,
+    "TEMPERATURE": 0.7,
+    "STREAM": True,
+    "STREAM_FLUSH_MS": 30,
+    "CONTEXT_TOKEN_BUDGET": 12000,
+    "MAX_CONTINUATIONS": 3,
+    "RESPONSE_CACHE": True,
+    "RESPONSE_CACHE_TEMPERATURE_ZERO_ONLY": True,
+    "RESPONSE_CACHE_MAX_ENTRIES": 1000,
+    "RESPONSE_CACHE_MAX_AGE_DAYS": 30,
+    "CHAT_RENDER_WINDOW": 200,
+    "CHAT_RENDER_PAGE": 50,
+    "HISTORY_FSYNC_SECONDS": 5,
+    "MAX_RETRIES": 5,
+    "TPM_QUOTA": 0,
+    "RPM_QUOTA": 0,
+    "HISTORY_FOLDER": "",
+    "STREAM_INCLUDE_USAGE": False,
+    "METRICS_LOG": "metrics.jsonl",
+    "METRICS_LOG_MAX_BYTES": 5000000,
+    "PERSIST_FLUSH_SECONDS": 10,
+    "ATTACHMENT_CHUNK_TOKENS": 3000,
+    "ATTACHMENT_CONCURRENCY": 4,
+    "ENDPOINTS": [],
+    "API_VERSION": "2023-05-15",
+    "SYSTEM_PROMPT": "You are a helpful assistant.",
+    "PINNED_FILES": [],
+    "PREWARM": True,
+    "PREWARM_KEYSTROKES": 20,
+    "HISTORY_MEMORY_MB": 64,
+    "HYDRATED_TABS": 3
+}
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+def load_settings(path='setting.json'):
+    try:
+        with open(path, 'r') as f:
+            loaded_settings = json.load(f)
+            # Update default settings with loaded settings
+            return {**DEFAULT_SETTINGS, **loaded_settings}
+    except (FileNotFoundError, json.JSONDecodeError):
+        print("Error: setting.json file not found or invalid format. Using default settings.")
+        return dict(DEFAULT_SETTINGS)
+
+def history_folder(settings):
+    return settings["HISTORY_FOLDER"] or os.path.join(APP_FOLDER, "会話履歴")
+
+def create_client(settings, http_client=None):
+    return import_openai().AsyncAzureOpenAI(
+        api_key=settings["AZURE_OPENAI_KEY"],
+        api_version=settings["API_VERSION"],
+        azure_endpoint=settings["AZURE_OPENAI_ENDPOINT"],
+        http_client=http_client,
+        # Retries are handled by RequestScheduler so that every caller shares one backoff
+        max_retries=0
+    )
+
+class StartupTimer:
+    # Startup phases; with --startup-report each one is printed to stderr like `python -X importtime`
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        self.enabled = False
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def mark(self, phase, seconds=None):
+        # seconds is given for phases that ran in the background, otherwise the time since the last mark
+        now = time.perf_counter()
+        with self.lock:
+            if seconds is None:
+                seconds = now - self.last
+                self.last = now
+            self.phases.append((phase, seconds, now - self.started))
+            if self.enabled:
+                if len(self.phases) == 1:
+                    print("startup: self [ms] | cumulative [ms] | phase", file=sys.stderr)
+                print(f"startup: {seconds * 1000:9.1f} | {(now - self.started) * 1000:16.1f} | {phase}",
+                      file=sys.stderr, flush=True)
+
+STARTUP = StartupTimer(STARTUP_STARTED)
+
+# Ids handed out by this process, including ones whose file is not written yet
+ISSUED_CONVERSATION_IDS = set()
+ISSUED_CONVERSATION_IDS_LOCK = threading.Lock()
+
+def make_conversation_id(first_prompt, store=None):
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    sanitized_prompt = re.sub(r'[^\w\s-]', '', first_prompt)
+    sanitized_prompt = sanitized_prompt.strip()[:30]
+    sanitized_prompt = re.sub(r'\s+', '_', sanitized_prompt)
+    base = f"会話履歴_{timestamp}_{sanitized_prompt}"
+    # Prompts that start alike (or a.txt and a.md in a batch) in the same second get a counter
+    with ISSUED_CONVERSATION_IDS_LOCK:
+        conversation_id = base
+        suffix = 1
+        while conversation_id in ISSUED_CONVERSATION_IDS or (store and os.path.exists(store.path(conversation_id))):
+            suffix += 1
+            conversation_id = f"{base}_{suffix}"
+        ISSUED_CONVERSATION_IDS.add(conversation_id)
+    return conversation_id
+
+class TokenCounter:
+    # Per-message overhead of the chat format (role and separators)
+    MESSAGE_OVERHEAD = 4
+    READ_PAGE = 256
+    CACHE_ENTRIES = 4096
+
+    def __init__(self):
+        self.encoding = None
+        self.loaded = False
+        # Least recently used first; keyed by a digest so that no message text is kept alive by the cache
+        self.cache = collections.OrderedDict()
+
+    def load_encoding(self):
+        # Deferred until first needed: importing tiktoken and loading the encoding slow down startup
+        self.loaded = True
+        try:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # tiktoken is not installed or the encoding file could not be loaded (e.g. offline); use the estimate
+            pass
+
+    def count_text(self, text):
+        if not self.loaded:
+            self.load_encoding()
+        if self.encoding:
+            return len(self.encoding.encode(text))
+        # Rough estimate without tiktoken: ~1 token per non-ASCII character, ~4 ASCII characters per token
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+    def count_message(self, message):
+        if isinstance(message, Message):
+            # Kept on the record itself, so the count outlives a spilled text
+            if message.tokens is None:
+                message.tokens = self.count_text(message.content) + self.MESSAGE_OVERHEAD
+            return message.tokens
+        content = message["content"]
+        key = (message["role"], hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest())
+        count = self.cache.get(key)
+        if count is None:
+            count = self.count_text(content) + self.MESSAGE_OVERHEAD
+            self.cache[key] = count
+            if len(self.cache) > self.CACHE_ENTRIES:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return count
+
+    def count_messages(self, messages):
+        # Spilled messages that were never counted (e.g. a restored conversation) are read back a page at a time
+        uncounted = [m for m in messages if isinstance(m, Message) and m.tokens is None and m.text is None]
+        for start in range(0, len(uncounted), self.READ_PAGE):
+            page = uncounted[start:start + self.READ_PAGE]
+            for message, text in zip(page, message_texts(page)):
+                message.tokens = self.count_text(text) + self.MESSAGE_OVERHEAD
+        return [self.count_message(m) for m in messages]
+
+    def clear(self):
+        self.cache.clear()
+
+class PinnedContext:
+    # The system prompt and reference files sent at the start of every request, always in configured order.
+    # Files are read and tokenized once, and again only when their mtime or size changes.
+    def __init__(self, settings, counter):
+        self.counter = counter
+        self.paths = [os.path.join(APP_FOLDER, path) for path in settings["PINNED_FILES"]]
+        self.system_prompt = settings["SYSTEM_PROMPT"]
+        # Counted on first use rather than here: the tokenizer loads slowly and this runs before the window shows
+        self.system = None
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def blocks(self):
+        # (message, tokens) pairs; a file that cannot be read is left out until it can
+        with self.lock:
+            if self.system is None:
+                self.system = []
+                if self.system_prompt:
+                    message = {"role": "system", "content": self.system_prompt}
+                    self.system.append((message, self.counter.count_text(message["content"]) + self.counter.MESSAGE_OVERHEAD))
+            blocks = list(self.system)
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                version = (stat.st_mtime_ns, stat.st_size)
+                with self.lock:
+                    document = self.documents.get(path)
+                    if document is None or document[0] != version:
+                        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                            message = {"role": "system", "content": f"参考資料「{os.path.basename(path)}」:\n{f.read()}"}
+                        tokens = self.counter.count_text(message["content"]) + self.counter.MESSAGE_OVERHEAD
+                        document = self.documents[path] = (version, message, tokens)
+            except OSError as e:
+                print(f"Error: could not read pinned file {path}: {e}")
+                continue
+            blocks.append(document[1:])
+        return blocks
+
+class ContextWindow:
+    # Older messages are dropped in steps of this many, so the kept history starts at the same message
+    # for several turns and the request prefix stays the same
+    TRIM_STEP = 8
+
+    def __init__(self, counter, budget):
+        self.counter = counter
+        self.budget = budget
+        self.memo = None
+
+    def fit(self, messages, pinned=None):
+        # pinned (message, tokens) blocks replace the conversation's own leading system prompt;
+        # without them that system prompt is kept. Then as many recent messages as the budget allows.
+        own_head = [m for m in messages[:1] if m["role"] == "system"]
+        if pinned is None:
+            pinned = [(m, self.counter.count_message(m)) for m in own_head]
+        body = messages[len(own_head):]
+        # The last result is kept, so a draft fitted while the user types is reused when it is sent.
+        # Messages are compared by identity except the last one, which is a new object on send.
+        key = (tuple(id(m) for m, _ in pinned), tuple(id(m) for m in body[:-1]),
+               body[-1]["role"] if body else None, body[-1]["content"] if body else None)
+        if self.memo and self.memo[0] == key:
+            return self.memo[2]
+        result = self.trim(pinned, body)
+        # The inputs are kept referenced so that their ids in the key stay valid
+        self.memo = (key, (pinned, body), result)
+        return result
+
+    def trim(self, pinned, body):
+        head = [message for message, _ in pinned]
+        head_tokens = sum(tokens for _, tokens in pinned)
+        counts = self.counter.count_messages(body)
+        total_tokens = head_tokens + sum(counts)
+        if total_tokens <= self.budget or not body:
+            return head + body, {"total_tokens": total_tokens, "sent_tokens": total_tokens, "dropped": 0}
+
+        # The latest message is always sent; older ones are added while they still fit
+        start = len(body) - 1
+        used = head_tokens + counts[start]
+        used += self.counter.count_message(self.omission_note(len(body)))
+        while start > 0 and used + counts[start - 1] <= self.budget:
+            start -= 1
+            used += counts[start]
+        if len(body) - start > self.TRIM_STEP:
+            # Rounding drops at most TRIM_STEP - 1 messages that fit, so it is skipped when only a few fit
+            start = min(-(-start // self.TRIM_STEP) * self.TRIM_STEP, len(body) - 1)
+
+        note = self.omission_note(start)
+        trimmed = head + [note] + body[start:]
+        sent_tokens = sum(self.counter.count_message(m) for m in trimmed)
+        return trimmed, {"total_tokens": total_tokens, "sent_tokens": sent_tokens, "dropped": start}
+
+    def omission_note(self, dropped):
+        return {"role": "system", "content": f"（これより前の {dropped} 件のメッセージは省略されています）"}
+
+class ResponseCache:
+    # On-disk cache of completions keyed on the full request, evicted by age and least-recent use
+    def __init__(self, path, max_entries, max_age_days):
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, finish_reason TEXT, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(deployment, messages, temperature, max_tokens):
+        request = json.dumps(
+            {"deployment": deployment, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content, finish_reason, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[2] > self.max_age:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0], row[1]
+
+    def put(self, key, content, finish_reason):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, finish_reason, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, content, finish_reason, now, now)
+            )
+            self.evict(now)
+            self.conn.commit()
+
+    def evict(self, now):
+        self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age,))
+        self.conn.execute(
+            "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class TurnMetrics:
+    # Wall-clock time per stage of one turn, plus token usage; stages of continuation rounds are kept apart
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+        self.phase = ""
+        self.stages = {}
+        self.first_token = None
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "estimated": False}
+        self.cache_hits = 0
+        self.retries = 0
+        self.endpoint = ""
+
+    def add(self, stage, seconds):
+        key = f"{self.phase}.{stage}" if self.phase else stage
+        self.stages[key] = self.stages.get(key, 0.0) + seconds
+
+    def mark_first_token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.started
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+
+    def record(self):
+        return {
+            "timestamp": self.timestamp,
+            "total_ms": round(getattr(self, "total", time.perf_counter() - self.started) * 1000, 1),
+            "first_token_ms": round(self.first_token * 1000, 1) if self.first_token is not None else None,
+            "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()},
+            "prompt_tokens": self.usage["prompt_tokens"],
+            "completion_tokens": self.usage["completion_tokens"],
+            "cached_tokens": self.usage["cached_tokens"],
+            "usage_estimated": self.usage["estimated"],
+            "cache_hits": self.cache_hits,
+            "retries": self.retries,
+            "endpoint": self.endpoint,
+        }
+
+class MetricsLog:
+    # JSONL log of turn metrics, rotated to .1/.2/.3 when it grows past max_bytes
+    BACKUPS = 3
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def write(self, record):
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                for index in range(self.BACKUPS - 1, 0, -1):
+                    if os.path.exists(f"{self.path}.{index}"):
+                        os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+                os.replace(self.path, f"{self.path}.1")
+            with open(self.path, 'a', encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Error: could not write metrics log: {e}")
+
+def endpoint_settings(settings):
+    # ENDPOINTS entries override the top-level deployment settings; without any, the top-level one is used
+    entries = settings["ENDPOINTS"] or [{}]
+    result = []
+    for entry in entries:
+        result.append({
+            **settings,
+            "AZURE_OPENAI_ENDPOINT": entry.get("endpoint", settings["AZURE_OPENAI_ENDPOINT"]),
+            "AZURE_OPENAI_KEY": entry.get("key", settings["AZURE_OPENAI_KEY"]),
+            "DEPLOYMENT_NAME": entry.get("deployment", settings["DEPLOYMENT_NAME"]),
+            "TPM_QUOTA": entry.get("tpm", settings["TPM_QUOTA"]),
+            "RPM_QUOTA": entry.get("rpm", settings["RPM_QUOTA"]),
+            "ENDPOINT_NAME": entry.get("name", entry.get("deployment", settings["DEPLOYMENT_NAME"])),
+            "ENDPOINT_WEIGHT": entry.get("weight", 1),
+        })
+    return result
+
+class Endpoint:
+    # One deployment: its client, a token bucket sized to its quota and live latency/429 statistics
+    LATENCY_SMOOTHING = 0.3
+    # Assumed latency of an endpoint that has failed and never answered, so it is not preferred once unpaused
+    FAILED_LATENCY = 10.0
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.name = settings["ENDPOINT_NAME"]
+        self.deployment = settings["DEPLOYMENT_NAME"]
+        self.weight = max(float(settings["ENDPOINT_WEIGHT"]), 0.01)
+        self.tpm = settings["TPM_QUOTA"]
+        self.rpm = settings["RPM_QUOTA"]
+        self.client = None
+        self.tokens = float(self.tpm)
+        self.requests = float(self.rpm)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = None
+        self.latency = None
+        self.in_flight = 0
+        self.failures = 0
+        self.last_status = None
+        self.first_request = None
+        self.warmed = 0.0
+        self.stats = {"requests": 0, "completed": 0, "throttled": 0, "errors": 0, "tokens": 0}
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.tpm:
+            self.tokens = min(float(self.tpm), self.tokens + elapsed * self.tpm / 60)
+        if self.rpm:
+            self.requests = min(float(self.rpm), self.requests + elapsed * self.rpm / 60)
+
+    def wait_time(self, tokens, now):
+        # Seconds until this endpoint could send a request of this size
+        self.refill(now)
+        wait = self.paused_until - now
+        need = min(tokens, self.tpm) if self.tpm else 0
+        if self.tpm and self.tokens < need:
+            wait = max(wait, (need - self.tokens) * 60 / self.tpm)
+        if self.rpm and self.requests < 1:
+            wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+        return max(wait, 0.0)
+
+    def score(self, tokens, now):
+        # Expected time until a response starts: waiting for quota, then the observed latency per queued request.
+        # An endpoint without measurements yet counts as fast so that it gets tried, unless it has already failed.
+        if self.latency is not None:
+            latency = self.latency
+        else:
+            latency = self.FAILED_LATENCY if self.failures else 0.0
+        return self.wait_time(tokens, now) + latency * (self.in_flight + 1) / self.weight
+
+    async def acquire(self, tokens):
+        if self.lock is None:
+            # Created on the loop that uses it
+            self.lock = asyncio.Lock()
+        # The lock is FIFO, so waiting requests are served in order instead of being dropped
+        async with self.lock:
+            while True:
+                wait = self.wait_time(tokens, time.monotonic())
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.tokens -= min(tokens, self.tpm) if self.tpm else 0
+            self.requests -= 1
+
+    def observe(self, headers):
+        # The server's view of the quota wins when it is stricter than the local bucket
+        try:
+            remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+            if remaining_tokens is not None and self.tpm:
+                self.tokens = min(self.tokens, float(remaining_tokens))
+            remaining_requests = headers.get("x-ratelimit-remaining-requests")
+            if remaining_requests is not None and self.rpm:
+                self.requests = min(self.requests, float(remaining_requests))
+        except ValueError:
+            pass
+
+    def begin(self, tokens):
+        if self.first_request is None:
+            self.first_request = time.monotonic()
+        self.in_flight += 1
+        self.stats["requests"] += 1
+        self.stats["tokens"] += tokens
+
+    def succeed(self, seconds):
+        self.failures = 0
+        self.stats["completed"] += 1
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.LATENCY_SMOOTHING * (seconds - self.latency)
+
+    def fail(self, status, delay):
+        # Throttled or failing endpoints are skipped until the delay has passed
+        self.failures += 1
+        self.last_status = status
+        if status == 429:
+            self.stats["throttled"] += 1
+        else:
+            self.stats["errors"] += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def health(self):
+        wait = self.paused_until - time.monotonic()
+        if wait <= 0:
+            return "正常"
+        if self.last_status == 429:
+            return f"制限中 {wait:.0f}秒"
+        return f"障害 {wait:.0f}秒"
+
+    def throughput(self):
+        # Completed requests and charged tokens per minute since the first request
+        if self.first_request is None:
+            return 0.0, 0.0
+        minutes = max(time.monotonic() - self.first_request, 1.0) / 60
+        return self.stats["completed"] / minutes, self.stats["tokens"] / minutes
+
+def describe_endpoint(endpoint):
+    requests_per_minute, tokens_per_minute = endpoint.throughput()
+    latency = f"{endpoint.latency * 1000:.0f} ms" if endpoint.latency is not None else "-"
+    return (f"{endpoint.name}: {endpoint.health()}  応答 {latency}  完了 {endpoint.stats['completed']} 件"
+            f"（{requests_per_minute:.1f} 件/分, {tokens_per_minute:.0f} トークン/分）"
+            f"  429 {endpoint.stats['throttled']}  エラー {endpoint.stats['errors']}")
+
+class RequestScheduler:
+    # Routes each request to the endpoint expected to answer first, and retries with jittered backoff that
+    # honours Retry-After; a throttled or failing endpoint is left alone while another one can take the request
+    RETRY_STATUS = (408, 409, 429, 500, 502, 503, 504)
+    # Wrong key, permissions or deployment name: that endpoint will not recover by itself, another one may work
+    ENDPOINT_FAULT_STATUS = (401, 403, 404)
+    ENDPOINT_FAULT_PAUSE = 60.0
+    MAX_BACKOFF = 60.0
+    # Pooled connections are closed after about 5 seconds idle, so warming more often than this is wasted
+    PREWARM_INTERVAL = 3.0
+
+    def __init__(self, settings, on_status=None):
+        self.max_retries = settings["MAX_RETRIES"]
+        self.on_status = on_status or (lambda key, text: None)
+        self.endpoints = [Endpoint(endpoint) for endpoint in endpoint_settings(settings)]
+        self.http_client = None
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "queued_seconds": 0.0}
+
+    def connect(self, http_client=None):
+        # One client per endpoint; with http_client they all share its connection pool
+        self.http_client = http_client
+        for endpoint in self.endpoints:
+            if endpoint.client is None:
+                endpoint.client = create_client(endpoint.settings, http_client)
+
+    async def prewarm(self):
+        # A HEAD request through the shared pool opens (or keeps open) a connection to every endpoint,
+        # so the next real request skips DNS, TCP and TLS setup. The response itself does not matter.
+        if self.http_client is None:
+            return
+        now = time.monotonic()
+        endpoints = [endpoint for endpoint in self.endpoints if now - endpoint.warmed >= self.PREWARM_INTERVAL]
+        for endpoint in endpoints:
+            endpoint.warmed = now
+        await asyncio.gather(*(
+            self.http_client.head(endpoint.settings["AZURE_OPENAI_ENDPOINT"], timeout=5.0) for endpoint in endpoints
+        ), return_exceptions=True)
+
+    def pick(self, tokens):
+        now = time.monotonic()
+        return min(self.endpoints, key=lambda endpoint: (endpoint.score(tokens, now), random.random()))
+
+    async def call(self, create, tokens, metrics):
+        # create(endpoint) sends the request with that endpoint's client and deployment
+        attempt = 0
+        while True:
+            endpoint = self.pick(tokens)
+            if endpoint.client is None:
+                endpoint.client = create_client(endpoint.settings, self.http_client)
+            wait = endpoint.paused_until - time.monotonic()
+            if attempt and wait > 0:
+                # Every endpoint is throttled or failing; wait for the first one to come back
+                self.on_status("retry", f"再試行待ち: {wait:.1f}秒（{attempt}回目）")
+                await asyncio.sleep(wait)
+                metrics.add("backoff", wait)
+            started = time.perf_counter()
+            await endpoint.acquire(tokens)
+            sent = time.perf_counter()
+            metrics.add("queue", sent - started)
+            self.stats["queued_seconds"] += sent - started
+            self.stats["requests"] += 1
+            endpoint.begin(tokens)
+            try:
+                raw = await create(endpoint)
+            except (openai.APIStatusError, openai.APIConnectionError) as e:
+                metrics.add("network", time.perf_counter() - sent)
+                status = getattr(e, "status_code", None)
+                if status in self.ENDPOINT_FAULT_STATUS:
+                    endpoint.fail(status, self.ENDPOINT_FAULT_PAUSE)
+                    retryable = self.has_alternative(endpoint)
+                else:
+                    retryable = status is None or status in self.RETRY_STATUS
+                    endpoint.fail(status, self.retry_delay(e, endpoint.failures) if retryable else 0.0)
+                self.report_health()
+                if attempt >= self.max_retries or not retryable:
+                    raise
+                if status == 429:
+                    self.stats["throttled"] += 1
+                attempt += 1
+                self.stats["retries"] += 1
+                metrics.retries += 1
+                continue
+            finally:
+                endpoint.in_flight -= 1
+            metrics.add("network", time.perf_counter() - sent)
+            endpoint.succeed(time.perf_counter() - sent)
+            metrics.endpoint = endpoint.name
+            if attempt:
+                self.on_status("retry", "")
+            endpoint.observe(raw.headers)
+            self.report_health()
+            return raw.parse()
+
+    def has_alternative(self, endpoint):
+        # Another endpoint that is not paused for a fault of its own
+        now = time.monotonic()
+        return any(other is not endpoint and (other.last_status not in self.ENDPOINT_FAULT_STATUS
+                                              or other.paused_until <= now) for other in self.endpoints)
+
+    async def close(self):
+        for endpoint in self.endpoints:
+            if endpoint.client:
+                await endpoint.client.close()
+
+    def report_health(self):
+        if len(self.endpoints) < 2:
+            return
+        self.on_status("endpoints", "  ".join(f"{endpoint.name}: {endpoint.health()}" for endpoint in self.endpoints))
+
+    def retry_delay(self, error, attempt):
+        response = getattr(error, "response", None)
+        headers = response.headers if response is not None else {}
+        retry_after = None
+        if headers.get("retry-after-ms"):
+            try:
+                retry_after = float(headers["retry-after-ms"]) / 1000
+            except ValueError:
+                pass
+        if retry_after is None and headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                retry_after = float(value)
+            except ValueError:
+                try:
+                    date = email.utils.parsedate_to_datetime(value)
+                    retry_after = (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    pass
+        if retry_after is not None and retry_after >= 0:
+            # A little jitter so that waiting requests do not all fire at the same instant
+            return min(retry_after, self.MAX_BACKOFF) * random.uniform(1.0, 1.1)
+        return random.uniform(0, min(self.MAX_BACKOFF, 0.5 * 2 ** attempt))
+
+class CompletionRunner:
+    # Request, cache and continuation logic shared by the window and the batch mode
+    CONTINUE_PROMPT = "続きをお願いします。前回の応答の続きだけを、重複させずにそのまま出力してください。"
+
+    def __init__(self, settings, client=None, response_cache=None, on_delta=None, on_status=None):
+        # client, if given, serves the top-level deployment; otherwise clients are made per endpoint
+        self.settings = settings
+        self.response_cache = response_cache
+        self.on_delta = on_delta or (lambda delta: None)
+        self.on_status = on_status or (lambda key, text: None)
+        self.scheduler = RequestScheduler(settings, self.on_status)
+        # The endpoint is picked after the cache lookup, so cached replies are keyed on every deployment that
+        # could serve the request; with one endpoint this is its deployment, as before ENDPOINTS existed
+        self.cache_deployment = ",".join(sorted({endpoint.deployment for endpoint in self.scheduler.endpoints}))
+        if client is not None and not settings["ENDPOINTS"]:
+            self.scheduler.endpoints[0].client = client
+        self.token_counter = TokenCounter()
+        self.context_window = ContextWindow(self.token_counter, settings["CONTEXT_TOKEN_BUDGET"])
+        self.pinned = PinnedContext(settings, self.token_counter)
+        self.saved_prompt_tokens = 0
+        self.avoided_continuations = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+
+    async def complete(self, messages, stream, reply, metrics=None, pinned=True, on_delta=None):
+        # pinned=False sends messages as they are, without the system prompt and pinned files.
+        # on_delta, if given, receives this call's deltas instead of the runner's on_delta.
+        metrics = metrics or TurnMetrics()
+        on_delta = on_delta or self.on_delta
+        finish_reason = await self.request(messages, stream, reply, metrics, pinned, on_delta)
+
+        # 応答がトークン上限で打ち切られた場合のみ続きを要求し、同じメッセージにつなげる
+        rounds = 0
+        while finish_reason == "length" and rounds < self.settings["MAX_CONTINUATIONS"]:
+            rounds += 1
+            metrics.phase = "continuation"
+            continuation = messages + [
+                {"role": "assistant", "content": "".join(reply)},
+                {"role": "user", "content": self.CONTINUE_PROMPT}
+            ]
+            finish_reason = await self.request(continuation, stream, reply, metrics, pinned, on_delta)
+        metrics.phase = ""
+
+        if rounds == 0 and not "".join(reply).strip().endswith(('。', '．', '.', '!', '?', '：', ':', ';', '；')):
+            # The old punctuation check would have made a second request here
+            self.avoided_continuations += 1
+            self.on_status("continuation", f"続き要求の省略: {self.avoided_continuations}回")
+        return {"finish_reason": finish_reason, "rounds": rounds, "usage": metrics.usage, "metrics": metrics}
+
+    async def request(self, messages, stream, reply, metrics, pinned=True, on_delta=None):
+        on_delta = on_delta or self.on_delta
+        prepare_started = time.perf_counter()
+        messages, context_stats = self.context_window.fit(messages, self.pinned.blocks() if pinned else [])
+        messages = resolve_messages(messages)
+        self.report_context_stats(context_stats)
+        start = len(reply)
+
+        cache_key = None
+        if self.use_response_cache():
+            cache_key = ResponseCache.make_key(
+                self.cache_deployment, messages, self.settings["TEMPERATURE"], self.settings["MAX_TOKENS"]
+            )
+            cached = self.response_cache.get(cache_key)
+            self.report_cache_stats()
+            if cached:
+                content, finish_reason = cached
+                reply.append(content)
+                metrics.cache_hits += 1
+                metrics.mark_first_token()
+                if stream:
+                    on_delta(content)
+                metrics.add("prepare", time.perf_counter() - prepare_started)
+                return finish_reason
+        metrics.add("prepare", time.perf_counter() - prepare_started)
+
+        options = {}
+        if stream and self.settings["STREAM_INCLUDE_USAGE"]:
+            options["stream_options"] = {"include_usage": True}
+        # Azure charges prompt tokens plus max_tokens against the TPM quota when the request arrives
+        response = await self.scheduler.call(
+            lambda endpoint: endpoint.client.chat.completions.with_raw_response.create(
+                model=endpoint.deployment,
+                messages=messages,
+                max_tokens=self.settings["MAX_TOKENS"],
+                temperature=self.settings["TEMPERATURE"],
+                stop=None,
+                stream=stream,
+                **options
+            ),
+            context_stats["sent_tokens"] + self.settings["MAX_TOKENS"],
+            metrics
+        )
+        response_usage = None
+        generation_started = time.perf_counter()
+        if not stream:
+            choice = response.choices[0]
+            reply.append(choice.message.content or "")
+            metrics.mark_first_token()
+            finish_reason = choice.finish_reason
+            response_usage = response.usage
+        else:
+            # Hand each delta to the caller as it arrives
+            finish_reason = None
+            try:
+                async for chunk in response:
+                    if getattr(chunk, "usage", None):
+                        response_usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    delta = choice.delta.content
+                    if delta:
+                        metrics.mark_first_token()
+                        reply.append(delta)
+                        on_delta(delta)
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+            finally:
+                # Closing releases the pooled connection, also when the job is cancelled mid-stream
+                await response.close()
+                metrics.add("generation", time.perf_counter() - generation_started)
+
+        content = "".join(reply[start:])
+        usage = metrics.usage
+        if response_usage:
+            usage["prompt_tokens"] += response_usage.prompt_tokens
+            usage["completion_tokens"] += response_usage.completion_tokens
+            # Reported by newer API versions: the part of the prompt served from the deployment's prefix cache
+            details = getattr(response_usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(details, "cached_tokens", None) or 0
+            usage["cached_tokens"] += cached_tokens
+            self.report_prefix_stats(response_usage.prompt_tokens, cached_tokens)
+        else:
+            # Streams only carry usage when the deployment is asked for it; estimate otherwise
+            usage["prompt_tokens"] += context_stats["sent_tokens"]
+            usage["completion_tokens"] += self.token_counter.count_text(content)
+            usage["estimated"] = True
+        if cache_key and finish_reason:
+            self.response_cache.put(cache_key, content, finish_reason)
+        return finish_reason
+
+    async def prewarm(self, messages):
+        # Speculative work while the user is typing: fit and tokenize the draft request, and open connections
+        self.context_window.fit(messages, self.pinned.blocks())
+        await self.scheduler.prewarm()
+
+    def use_response_cache(self):
+        if not self.response_cache:
+            return False
+        return self.settings["TEMPERATURE"] == 0 or not self.settings["RESPONSE_CACHE_TEMPERATURE_ZERO_ONLY"]
+
+    def report_cache_stats(self):
+        cache = self.response_cache
+        self.on_status("cache", f"キャッシュ: ヒット {cache.hits} / ミス {cache.misses}")
+
+    def report_prefix_stats(self, prompt_tokens, cached_tokens):
+        self.prompt_tokens += prompt_tokens
+        self.cached_prompt_tokens += cached_tokens
+        if self.cached_prompt_tokens:
+            share = self.cached_prompt_tokens / max(self.prompt_tokens, 1)
+            self.on_status("prefix", f"キャッシュ済み入力: {self.cached_prompt_tokens} トークン（{share:.0%}）")
+
+    def report_context_stats(self, context_stats):
+        saved = context_stats["total_tokens"] - context_stats["sent_tokens"]
+        self.saved_prompt_tokens += max(saved, 0)
+        status = f"送信トークン: {context_stats['sent_tokens']} / {context_stats['total_tokens']}"
+        if context_stats["dropped"]:
+            status += f"（{context_stats['dropped']} 件省略, {saved} 削減）"
+        status += f"  累計削減: {self.saved_prompt_tokens}"
+        self.on_status("context", status)
+
+def open_response_cache(settings):
+    if not settings["RESPONSE_CACHE"]:
+        return None
+    return ResponseCache(
+        os.path.join(APP_FOLDER, "response_cache.sqlite3"),
+        settings["RESPONSE_CACHE_MAX_ENTRIES"],
+        settings["RESPONSE_CACHE_MAX_AGE_DAYS"]
+    )
+
+class RequestEngine:
+    # Runs request jobs on an asyncio loop in a background thread, sharing one pooled HTTP client.
+    # The SDK is imported on that thread once start() is called; jobs submitted before then wait in the loop.
+    def __init__(self, settings, on_ready=None):
+        self.settings = settings
+        self.on_ready = on_ready or (lambda engine: None)
+        self.loop = asyncio.new_event_loop()
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.http_client = None
+        self.startup_error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop, name="RequestEngine", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.create_clients()
+        self.loop.run_forever()
+
+    def create_clients(self):
+        started = time.perf_counter()
+        try:
+            sdk = import_openai()
+            STARTUP.mark("import openai (background)", time.perf_counter() - started)
+            self.http_client = sdk.DefaultAsyncHttpxClient()
+        except Exception as e:
+            self.startup_error = e
+        self.on_ready(self)
+        STARTUP.mark("client ready (background)", time.perf_counter() - started)
+        self.ready.set()
+
+    def submit(self, key, coro):
+        # One job per key (conversation); different keys run concurrently
+        return asyncio.run_coroutine_threadsafe(self.run_job(key, coro), self.loop)
+
+    async def run_job(self, key, coro):
+        task = asyncio.ensure_future(coro)
+        with self.lock:
+            self.tasks[key] = task
+        try:
+            return await task
+        finally:
+            with self.lock:
+                if self.tasks.get(key) is task:
+                    del self.tasks[key]
+
+    def cancel(self, key):
+        with self.lock:
+            task = self.tasks.get(key)
+        if task:
+            self.loop.call_soon_threadsafe(task.cancel)
+
+    def shutdown(self, timeout=2.0):
+        async def close():
+            with self.lock:
+                tasks = list(self.tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.http_client:
+                await self.http_client.aclose()
+            await self.loop.shutdown_asyncgens()
+
+        if not self.thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(close(), self.loop).result(timeout)
+        except Exception as e:
+            print(f"Error: request engine did not shut down cleanly: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+MARKDOWN_ROLE_LABELS = {"system": "システム", "user": "あなた", "assistant": "AI"}
+MARKDOWN_ROLE_PATTERN = re.compile(r"^\*\*(" + "|".join(MARKDOWN_ROLE_LABELS.values()) + r")\*\*: ", re.MULTILINE)
+# Heading lines before a label: older versions wrote "# 会話履歴 - <time>" before every save, not only at the top
+MARKDOWN_HEADINGS = re.compile(r"(?:#[^\n]*\n|\n)*")
+
+def iter_markdown(messages):
+    for entry in messages:
+        label = MARKDOWN_ROLE_LABELS.get(entry["role"])
+        if label:
+            yield f"**{label}**: {entry['content']}\n\n"
+        yield "---\n\n"
+
+def parse_markdown(text):
+    # Reads back files written by iter_markdown (older versions of 会話履歴/*.md and latest_chat.md)
+    labels = {label: role for role, label in MARKDOWN_ROLE_LABELS.items()}
+    messages = []
+    blocks = text.split("\n\n---\n\n")
+    if blocks and not blocks[-1]:
+        # The rule written after the last message
+        blocks.pop()
+    for block in blocks:
+        # A block starts a message when only headings come before its label (anything, in the first block)
+        match = MARKDOWN_ROLE_PATTERN.search(block)
+        if match and messages and not MARKDOWN_HEADINGS.fullmatch(block, 0, match.start()):
+            match = None
+        if match:
+            messages.append({"role": labels[match.group(1)], "content": block[match.end():]})
+        elif messages:
+            # A "---" rule inside a message, not a separator
+            messages[-1]["content"] += "\n\n---\n\n" + block
+    return messages
+
+def is_conversation_file(path):
+    # Saved conversations have a role label near the top; any other file is treated as an attachment
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        head = f.read(4096)
+    return bool(MARKDOWN_ROLE_PATTERN.search(head))
+
+def write_atomic(path, chunks):
+    # Written next to the target and renamed over it, so a crash leaves the old file or the new one, never half of one
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+class PersistenceWorker:
+    # Single writer thread for the UI: jobs run in submission order, consecutive appends to the same
+    # conversation are merged, and whole-file writes are coalesced per path so only the latest is written
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.replacements = {}
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="persistence", daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        with self.condition:
+            self.jobs.append(["call", function, args])
+            self.condition.notify_all()
+
+    def append(self, key, messages, write):
+        with self.condition:
+            last = self.jobs[-1] if self.jobs else None
+            if last and last[0] == "append" and last[1] == key:
+                last[2].extend(messages)
+                # The newest callback writes them all (it may also time the save for its turn)
+                last[3] = write
+            else:
+                self.jobs.append(["append", key, list(messages), write])
+            self.condition.notify_all()
+
+    def replace(self, path, produce):
+        # produce() is called on the worker and returns the chunks of the new file
+        with self.condition:
+            self.replacements[path] = produce
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs and not self.replacements and not self.closed:
+                    self.condition.wait()
+                if not self.jobs and not self.replacements:
+                    return
+                jobs, self.jobs = self.jobs, []
+                replacements, self.replacements = self.replacements, {}
+            for job in jobs:
+                try:
+                    if job[0] == "append":
+                        job[3](job[2])
+                    else:
+                        job[1](*job[2])
+                except Exception as e:
+                    print(f"Error: could not save: {e}")
+            for path, produce in replacements.items():
+                try:
+                    write_atomic(path, produce())
+                except Exception as e:
+                    print(f"Error: could not write {path}: {e}")
+
+    def close(self, timeout):
+        # Finishes everything already queued; returns False if that took longer than timeout
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+class ConversationStore:
+    # Each conversation is an append-only JSONL file with a companion .idx file of record offsets
+    OFFSET = struct.Struct("<Q")
+
+    def __init__(self, folder, fsync_interval):
+        self.folder = folder
+        self.fsync_interval = fsync_interval
+        self.files = {}
+        self.last_fsync = time.monotonic()
+        self.lock = threading.Lock()
+
+    def path(self, conversation_id, extension=".jsonl"):
+        return os.path.join(self.folder, conversation_id + extension)
+
+    def open_files(self, conversation_id):
+        files = self.files.get(conversation_id)
+        if files is None:
+            self.repair(conversation_id)
+            data = open(self.path(conversation_id), 'ab', buffering=65536)
+            index = open(self.path(conversation_id, ".idx"), 'ab', buffering=4096)
+            files = self.files[conversation_id] = (data, index)
+        return files
+
+    def repair(self, conversation_id):
+        # A crash can leave a torn record at the end of the data file, and the index ahead of or behind the
+        # data. Before appending, the torn tail is cut off and the index is rebuilt after the last good record.
+        try:
+            size = os.path.getsize(self.path(conversation_id))
+        except FileNotFoundError:
+            return
+        with open(self.path(conversation_id, ".idx"), 'ab'):
+            pass
+        with open(self.path(conversation_id, ".idx"), 'r+b') as index, open(self.path(conversation_id), 'r+b') as data:
+            count = os.path.getsize(self.path(conversation_id, ".idx")) // self.OFFSET.size
+            # Entries pointing past the data were written for records that never reached the disk
+            offset = size
+            while count and offset >= size:
+                count -= 1
+                index.seek(count * self.OFFSET.size)
+                offset, = self.OFFSET.unpack(index.read(self.OFFSET.size))
+            if offset >= size:
+                offset = 0
+            # The last indexed record is checked again along with anything written after it
+            offsets = []
+            end = offset
+            data.seek(offset)
+            for line in data:
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                offsets.append(end)
+                end += len(line)
+            if end < size:
+                print(f"Error: dropped a torn record at the end of conversation {conversation_id}")
+                data.truncate(end)
+            index.seek(count * self.OFFSET.size)
+            index.truncate()
+            for offset in offsets:
+                index.write(self.OFFSET.pack(offset))
+
+    def append(self, conversation_id, messages):
+        timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            data, index = self.open_files(conversation_id)
+            offset = data.tell()
+            for entry in messages:
+                line = json.dumps(
+                    {"role": entry["role"], "content": entry["content"], "time": timestamp}, ensure_ascii=False
+                ).encode("utf-8") + b"\n"
+                data.write(line)
+                index.write(self.OFFSET.pack(offset))
+                offset += len(line)
+            data.flush()
+            index.flush()
+            if time.monotonic() - self.last_fsync >= self.fsync_interval:
+                self.sync()
+
+    def sync(self):
+        for data, index in self.files.values():
+            os.fsync(data.fileno())
+            os.fsync(index.fileno())
+        self.last_fsync = time.monotonic()
+
+    def count(self, conversation_id):
+        with self.lock:
+            if conversation_id in self.files:
+                self.files[conversation_id][1].flush()
+            try:
+                return os.path.getsize(self.path(conversation_id, ".idx")) // self.OFFSET.size
+            except FileNotFoundError:
+                return 0
+
+    def conversations(self):
+        return [name[:-len(".jsonl")] for name in os.listdir(self.folder) if name.endswith(".jsonl")]
+
+    def load(self, conversation_id, start=0):
+        messages = []
+        with self.lock:
+            if conversation_id in self.files:
+                for f in self.files[conversation_id]:
+                    f.flush()
+            offset = 0
+            if start:
+                with open(self.path(conversation_id, ".idx"), 'rb') as f:
+                    f.seek(start * self.OFFSET.size)
+                    offset, = self.OFFSET.unpack(f.read(self.OFFSET.size))
+            with open(self.path(conversation_id), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record torn by a crash can only be the last one; repair() cuts it off on next append
+                        if f.read(1):
+                            raise
+                        break
+                    messages.append({"role": record["role"], "content": record["content"]})
+        return messages
+
+    def read_messages(self, conversation_id, positions):
+        # Random access through the offset index, opening each file once for all positions
+        messages = []
+        with self.lock:
+            if conversation_id in self.files:
+                for f in self.files[conversation_id]:
+                    f.flush()
+            with open(self.path(conversation_id, ".idx"), 'rb') as index, open(self.path(conversation_id), 'rb') as data:
+                for position in positions:
+                    index.seek(position * self.OFFSET.size)
+                    offset, = self.OFFSET.unpack(index.read(self.OFFSET.size))
+                    data.seek(offset)
+                    record = json.loads(data.readline())
+                    messages.append({"role": record["role"], "content": record["content"]})
+        return messages
+
+    def latest(self):
+        conversations = self.conversations()
+        if not conversations:
+            return None
+        return max(conversations, key=lambda name: os.path.getmtime(self.path(name)))
+
+    def export_markdown(self, conversation_id, path):
+        messages = self.load(conversation_id)
+        write_atomic(path, itertools.chain([f"# 会話履歴 - {conversation_id}\n\n"], iter_markdown(messages)))
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            for data, index in self.files.values():
+                data.close()
+                index.close()
+            self.files.clear()
+
+class Message:
+    # One message of the open conversation. Reads like the plain dicts used elsewhere (message["content"]),
+    # but text is None once it has been spilled to the conversation file, where position points to it.
+    __slots__ = ("role", "text", "position", "tokens", "history")
+
+    def __init__(self, history, role, text, position=None):
+        self.history = history
+        self.role = sys.intern(role)
+        self.text = text
+        self.position = position
+        self.tokens = None
+
+    @property
+    def content(self):
+        text = self.text
+        if text is None:
+            text = self.history.read([self])[0]
+        return text
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+class ConversationHistory:
+    # The messages of the open conversation. Once the resident texts exceed memory_limit bytes, texts of
+    # saved messages are dropped oldest first and read back from the conversation file when needed.
+    def __init__(self, store, memory_limit, conversation_id=None):
+        self.store = store
+        self.memory_limit = memory_limit
+        self.conversation_id = conversation_id
+        self.messages = []
+        self.resident_bytes = 0
+        self.spill_from = 1     # the leading system prompt is always kept
+        self.lock = threading.Lock()
+
+    def append(self, role, text, position=None):
+        message = Message(self, role, text, position)
+        with self.lock:
+            self.messages.append(message)
+            self.resident_bytes += sys.getsizeof(text)
+        return message
+
+    def mark_saved(self, conversation_id, start, messages):
+        # Called by the persistence worker once messages are in the conversation file
+        with self.lock:
+            self.conversation_id = conversation_id
+            for position, message in enumerate(messages, start):
+                message.position = position
+        self.spill()
+
+    def spill(self):
+        with self.lock:
+            while self.resident_bytes > self.memory_limit and self.spill_from < len(self.messages):
+                message = self.messages[self.spill_from]
+                if message.position is None:
+                    # Not saved yet; everything after it is newer
+                    break
+                if message.text is not None:
+                    self.resident_bytes -= sys.getsizeof(message.text)
+                    message.text = None
+                self.spill_from += 1
+
+    def read(self, messages):
+        # Texts are not kept after reading, so memory stays within the limit
+        return [entry["content"] for entry in
+                self.store.read_messages(self.conversation_id, [message.position for message in messages])]
+
+def message_texts(messages):
+    # Texts of plain dicts and Message records alike; spilled ones are read back in one pass per conversation
+    texts = [message["content"] if isinstance(message, dict) else message.text for message in messages]
+    spilled = {}
+    for index, text in enumerate(texts):
+        if text is None:
+            spilled.setdefault(messages[index].history, []).append(index)
+    for history, indexes in spilled.items():
+        for index, text in zip(indexes, history.read([messages[index] for index in indexes])):
+            texts[index] = text
+    return texts
+
+def resolve_messages(messages):
+    # Plain dicts, as the API and the response cache expect
+    return [{"role": message["role"], "content": text} for message, text in zip(messages, message_texts(messages))]
+
+class SearchIndex:
+    # SQLite FTS5 index over saved messages; the trigram tokenizer works without word boundaries (Japanese)
+    def __init__(self, path, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+            "content, conversation UNINDEXED, role UNINDEXED, position UNINDEXED, tokenize='trigram')"
+        )
+        # How many messages of each conversation are indexed, so catching up never re-reads a whole file
+        self.conn.execute("CREATE TABLE IF NOT EXISTS indexed (conversation TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        self.conn.commit()
+
+    def add(self, conversation_id, start, messages):
+        with self.lock:
+            # Skip anything catch_up already indexed from the file
+            row = self.conn.execute("SELECT count FROM indexed WHERE conversation = ?", (conversation_id,)).fetchone()
+            indexed = row[0] if row else 0
+            self.conn.executemany(
+                "INSERT INTO messages (content, conversation, role, position) VALUES (?, ?, ?, ?)",
+                [(entry["content"], conversation_id, entry["role"], position)
+                 for position, entry in enumerate(messages, start) if position >= indexed]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO indexed (conversation, count) VALUES (?, ?)",
+                (conversation_id, max(indexed, start + len(messages)))
+            )
+            self.conn.commit()
+
+    def indexed_count(self, conversation_id):
+        with self.lock:
+            row = self.conn.execute("SELECT count FROM indexed WHERE conversation = ?", (conversation_id,)).fetchone()
+        return row[0] if row else 0
+
+    def catch_up(self):
+        # Indexes only messages saved while the index was not being updated (e.g. by an older version)
+        for conversation_id in self.store.conversations():
+            indexed = self.indexed_count(conversation_id)
+            if self.store.count(conversation_id) > indexed:
+                self.add(conversation_id, indexed, self.store.load(conversation_id, indexed))
+
+    def search(self, query, limit=100):
+        query = query.strip()
+        if not query:
+            return []
+        with self.lock:
+            if len(query) >= 3:
+                return self.conn.execute(
+                    "SELECT conversation, position, role, snippet(messages, 0, '【', '】', '…', 16) "
+                    "FROM messages WHERE messages MATCH ? ORDER BY rank LIMIT ?",
+                    ('"' + query.replace('"', '""') + '"', limit)
+                ).fetchall()
+            # Trigrams cannot match one- or two-character queries, so scan instead
+            return self.conn.execute(
+                "SELECT conversation, position, role, substr(content, max(instr(content, ?) - 16, 1), 40) "
+                "FROM messages WHERE instr(content, ?) > 0 ORDER BY rowid DESC LIMIT ?",
+                (query, query, limit)
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def record_messages(store, search_index, conversation_id, messages):
+    # Returns the position of the first message in the conversation file
+    store.append(conversation_id, messages)
+    start = store.count(conversation_id) - len(messages)
+    search_index.add(conversation_id, start, messages)
+    return start
+
+def iter_text_chunks(path, counter, chunk_tokens):
+    # Streams the file line by line and yields (text, bytes read so far) pieces of about chunk_tokens tokens,
+    # so only one chunk of the file is in memory at a time
+    parts = []
+    tokens = 0
+    position = 0
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            position += len(line.encode('utf-8'))
+            line_tokens = counter.count_text(line)
+            pieces = [(line, line_tokens)]
+            if line_tokens > chunk_tokens:
+                # A single overlong line (e.g. minified data) is cut by characters
+                step = max(len(line) * chunk_tokens // line_tokens, 1)
+                pieces = [(line[i:i + step], counter.count_text(line[i:i + step])) for i in range(0, len(line), step)]
+            for piece, piece_tokens in pieces:
+                if parts and tokens + piece_tokens > chunk_tokens:
+                    yield "".join(parts), position
+                    parts = []
+                    tokens = 0
+                parts.append(piece)
+                tokens += piece_tokens
+    if parts:
+        yield "".join(parts), position
+
+class AttachmentSummarizer:
+    # Map-reduce summary of a file too large for one request: each chunk is summarized with bounded
+    # concurrency, then the summaries are merged group by group until one is left
+    MAP_PROMPT = "以下は「{name}」の一部（{index} 番目）です。重要な内容を漏らさず簡潔に要約してください。\n\n{text}"
+    REDUCE_PROMPT = "以下は「{name}」を分割して要約したものです。重複をまとめ、全体の要約を作成してください。\n\n{text}"
+
+    def __init__(self, settings, runner, on_progress=None):
+        self.runner = runner
+        self.chunk_tokens = settings["ATTACHMENT_CHUNK_TOKENS"]
+        self.concurrency = max(settings["ATTACHMENT_CONCURRENCY"], 1)
+        self.on_progress = on_progress or (lambda text: None)
+
+    async def summarize_text(self, prompt):
+        reply = []
+        await self.runner.complete([{"role": "user", "content": prompt}], False, reply, pinned=False)
+        return "".join(reply)
+
+    async def summarize(self, path):
+        name = os.path.basename(path)
+        size = os.path.getsize(path) or 1
+        summaries = {}
+        tasks = []
+        read_fraction = 0.0
+        done = 0
+        # Taken before a chunk is read and released when its summary is back, which also bounds memory
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def map_chunk(index, text):
+            nonlocal done
+            try:
+                summaries[index] = await self.summarize_text(self.MAP_PROMPT.format(name=name, index=index + 1, text=text))
+            finally:
+                semaphore.release()
+            done += 1
+            self.on_progress(f"添付ファイルの要約: {done} / {len(tasks)} チャンク完了（読み込み {read_fraction:.0%}）")
+
+        chunks = iter_text_chunks(path, self.runner.token_counter, self.chunk_tokens)
+        try:
+            for text, position in chunks:
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(map_chunk(len(tasks), text)))
+                read_fraction = position / size
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            chunks.close()
+
+        results = [summaries[index] for index in range(len(tasks))]
+        while len(results) > 1:
+            groups = self.group(results)
+            self.on_progress(f"添付ファイルの要約: {len(results)} 件の要約を {len(groups)} 件に統合中")
+            results = await asyncio.gather(*(
+                self.reduce(semaphore, name, group) for group in groups
+            ))
+        return {"summary": results[0] if results else "", "chunks": len(tasks)}
+
+    def group(self, summaries):
+        groups = [[]]
+        tokens = 0
+        for summary in summaries:
+            summary_tokens = self.runner.token_counter.count_text(summary)
+            if groups[-1] and tokens + summary_tokens > self.chunk_tokens:
+                groups.append([])
+                tokens = 0
+            groups[-1].append(summary)
+            tokens += summary_tokens
+        if len(groups) == len(summaries):
+            # Every summary fills a chunk on its own; merge in pairs so the loop still converges
+            groups = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+        return groups
+
+    async def reduce(self, semaphore, name, group):
+        async with semaphore:
+            return await self.summarize_text(self.REDUCE_PROMPT.format(name=name, text="\n\n---\n\n".join(group)))
+
+class BatchRunner:
+    # Headless mode: runs every prompt file in a folder through CompletionRunner with a bounded worker pool
+    PROMPT_EXTENSIONS = (".txt", ".md")
+
+    def __init__(self, settings, prompt_folder, workers, output):
+        self.settings = settings
+        self.prompt_folder = prompt_folder
+        self.workers = max(workers, 1)
+        self.output = output
+        self.completed = 0
+        self.failed = 0
+        self.tokens = 0
+
+    def pending_prompts(self):
+        # Prompts that already have a successful line in the output are skipped, so a crashed run can resume
+        done = set()
+        if os.path.exists(self.output):
+            with open(self.output, 'r', encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut short by a crash
+                    if "error" not in record:
+                        done.add(record["prompt_file"])
+        names = sorted(name for name in os.listdir(self.prompt_folder) if name.endswith(self.PROMPT_EXTENSIONS))
+        return [name for name in names if name not in done]
+
+    async def run(self):
+        prompts = self.pending_prompts()
+        print(f"{len(prompts)} 件のプロンプトを {self.workers} 並列で処理します。")
+        folder = history_folder(self.settings)
+        os.makedirs(folder, exist_ok=True)
+        self.store = ConversationStore(folder, self.settings["HISTORY_FSYNC_SECONDS"])
+        self.search_index = SearchIndex(os.path.join(folder, "search_index.sqlite3"), self.store)
+        response_cache = open_response_cache(self.settings)
+        self.runner = CompletionRunner(self.settings, None, response_cache, on_status=self.print_status)
+        self.runner.scheduler.connect()
+
+        jobs = asyncio.Queue()
+        for name in prompts:
+            jobs.put_nowait(name)
+        started = time.monotonic()
+        try:
+            with open(self.output, 'a', encoding="utf-8") as self.results:
+                await asyncio.gather(*(self.worker(jobs) for _ in range(self.workers)))
+        finally:
+            # Also on Ctrl+C or an unexpected error, so saved conversations are fsynced and the index is closed
+            await self.runner.scheduler.close()
+            self.store.close()
+            self.search_index.close()
+            if response_cache:
+                response_cache.close()
+        elapsed = max(time.monotonic() - started, 1e-9)
+
+        stats = self.runner.scheduler.stats
+        print(
+            f"完了: {self.completed} 件, 失敗: {self.failed} 件, {elapsed:.1f} 秒 "
+            f"({self.completed / elapsed:.2f} req/s, {self.tokens / elapsed:.1f} tokens/s, "
+            f"再試行 {stats['retries']} 回, うち429 {stats['throttled']} 回)"
+        )
+        if len(self.runner.scheduler.endpoints) > 1:
+            for endpoint in self.runner.scheduler.endpoints:
+                print(describe_endpoint(endpoint))
+        return 1 if self.failed else 0
+
+    def print_status(self, key, text):
+        if key == "retry" and text:
+            print(text)
+
+    async def worker(self, jobs):
+        while True:
+            try:
+                name = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await self.process(name)
+
+    async def process(self, name):
+        started = time.monotonic()
+        record = {"prompt_file": name}
+        reply = []
+        # A file that cannot be read (e.g. not UTF-8) or a reply that cannot be saved fails this prompt only
+        try:
+            with open(os.path.join(self.prompt_folder, name), 'r', encoding="utf-8") as f:
+                prompt = f.read()
+            messages = [
+                {"role": "system", "content": self.settings["SYSTEM_PROMPT"]},
+                {"role": "user", "content": prompt}
+            ]
+            result = await self.runner.complete(messages, False, reply)
+            content = "".join(reply)
+            messages.append({"role": "assistant", "content": content})
+            conversation_id = make_conversation_id(os.path.splitext(name)[0], self.store)
+            record_messages(self.store, self.search_index, conversation_id, messages)
+        except Exception as e:
+            record["error"] = str(e)
+
+        if "error" in record:
+            self.failed += 1
+            print(f"失敗: {name}: {record['error']}")
+        else:
+            usage = result["usage"]
+            self.completed += 1
+            self.tokens += usage["prompt_tokens"] + usage["completion_tokens"]
+            record.update({
+                "conversation": conversation_id,
+                "content": content,
+                "finish_reason": result["finish_reason"],
+                "continuations": result["rounds"],
+                "usage": usage,
+                "metrics": result["metrics"].record(),
+            })
+            print(f"完了: {name} ({time.monotonic() - started:.1f} 秒)")
+        record["elapsed"] = round(time.monotonic() - started, 3)
+        self.results.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.results.flush()
+
+class ChatRecord:
+    # parts is None once the record has left the widget and its text is left to message (a conversation
+    # Message), shown after label; it is filled again before the record is drawn
+    __slots__ = ("header", "parts", "closed", "message", "label")
+
+    def __init__(self, header):
+        self.header = header
+        self.parts = []
+        self.closed = False
+        self.message = None
+        self.label = ""
+
+class ChatRenderer:
+    # Keeps only the most recent messages in the Text widget and loads older ones when scrolled to the top
+    DIVIDER = "-" * 50 + "\n"
+    FRAME_MS = 16
+
+    def __init__(self, widget, window, page, read_texts=None):
+        self.widget = widget
+        self.window = max(window, 1)
+        self.page = max(page, 1)
+        self.records = []
+        self.first = 0          # first record materialized in the widget
+        self.end = 0            # one past the last materialized record
+        self.tail_parts = 0     # parts of records[end - 1] already inserted
+        self.tail_closed = False
+        self.redraw_pending = False
+        self.redraw_seconds = 0.0
+        self.load_pending = False
+        self.open = None        # the record being streamed into
+        self.held = []          # complete records that arrived while it was open; shown after it
+        self.finished = None    # the record the last stream went into
+        # read_texts(messages) reads dropped texts off the Tk thread and hands them to show_older;
+        # without it they are read right away
+        self.read_texts = read_texts
+        self.loading = None     # (first, records, messages) whose texts are being read
+        self.set_scrollbar = widget.vbar.set
+        widget.configure(yscrollcommand=self.on_yscroll)
+
+    def new_record(self, role):
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return ChatRecord(f"{timestamp} - {role}\n")
+
+    def begin(self, role):
+        self.open = self.new_record(role)
+        self.records.append(self.open)
+        self.schedule_redraw()
+
+    def append(self, text):
+        if self.open:
+            self.open.parts.append(text)
+            self.schedule_redraw()
+
+    def end_message(self, text=""):
+        if self.open:
+            if text:
+                self.open.parts.append(text)
+            self.open.closed = True
+            self.finished, self.open = self.open, None
+            # Only the last record can grow in the widget, so messages shown meanwhile come after the reply
+            self.records.extend(self.held)
+            self.held = []
+            self.schedule_redraw()
+
+    def add(self, role, text):
+        # A complete message, e.g. a status line, which may arrive while a reply is still streaming
+        record = self.new_record(role)
+        record.parts.append(text)
+        record.closed = True
+        if self.open:
+            self.held.append(record)
+        else:
+            self.records.append(record)
+            self.schedule_redraw()
+        return record
+
+    def link(self, record, message, label):
+        # record shows message; its own copy of the text is dropped once it leaves the widget
+        if record is not None and record.message is None:
+            record.message = message
+            record.label = label
+
+    def render(self, record):
+        return record.header + "".join(record.parts) + (self.DIVIDER if record.closed else "")
+
+    def schedule_redraw(self):
+        # Rapid appends are coalesced into a single redraw per frame
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.widget.after(self.FRAME_MS, self.redraw)
+
+    def redraw(self):
+        started = time.perf_counter()
+        self.redraw_pending = False
+        following = self.widget.yview()[1] >= 0.999
+        self.widget.configure(state='normal')
+        if self.end:
+            record = self.records[self.end - 1]
+            tail = "".join(record.parts[self.tail_parts:])
+            if record.closed and not self.tail_closed:
+                tail += self.DIVIDER
+            if tail:
+                self.widget.insert(tk.END, tail)
+        for index in range(self.end, len(self.records)):
+            mark = f"msg{index}"
+            self.widget.mark_set(mark, "end-1c")
+            self.widget.mark_gravity(mark, tk.LEFT)
+            self.widget.insert(tk.END, self.render(self.records[index]))
+        self.end = len(self.records)
+        if self.end:
+            self.tail_parts = len(self.records[-1].parts)
+            self.tail_closed = self.records[-1].closed
+        if following:
+            # Only drop old messages while the user is looking at the latest ones
+            self.trim()
+        self.widget.configure(state='disabled')
+        if following:
+            self.widget.see(tk.END)
+        self.redraw_seconds += time.perf_counter() - started
+
+    def trim(self):
+        excess = (self.end - self.first) - self.window
+        if excess <= 0:
+            return
+        new_first = self.first + excess
+        self.widget.delete("1.0", f"msg{new_first}")
+        for index in range(self.first, new_first):
+            self.widget.mark_unset(f"msg{index}")
+            if self.records[index].message is not None:
+                self.records[index].parts = None
+        self.first = new_first
+
+    def on_yscroll(self, first, last):
+        self.set_scrollbar(first, last)
+        if float(first) <= 0.0 and self.first > 0 and not self.load_pending:
+            self.load_pending = True
+            self.widget.after_idle(self.load_older)
+
+    def load_older(self):
+        self.load_pending = False
+        if self.first == 0 or self.loading:
+            return
+        dropped = [record for record in self.records[max(0, self.first - self.page):self.first] if record.parts is None]
+        if not dropped:
+            self.insert_older()
+            return
+        messages = [record.message for record in dropped]
+        self.loading = (self.first, dropped, messages)
+        if self.read_texts:
+            self.read_texts(messages)
+        else:
+            self.show_older(messages, message_texts(messages))
+
+    def show_older(self, messages, texts):
+        # texts is None when they could not be read; scrolling to the top again retries.
+        # A read requested before the pane was cleared is ignored.
+        if self.loading is None or self.loading[2] is not messages:
+            return
+        first, dropped, _ = self.loading
+        self.loading = None
+        if texts is None or first != self.first:
+            return
+        for record, text in zip(dropped, texts):
+            record.parts = [record.label, text, "\n"]
+        self.insert_older()
+
+    def insert_older(self):
+        start = max(0, self.first - self.page)
+        texts = [self.render(record) for record in self.records[start:self.first]]
+        self.widget.configure(state='normal')
+        self.widget.insert("1.0", "".join(texts))
+        # Every materialized record ends with a newline, so marks can be placed by line number
+        line = 1
+        for index, text in enumerate(texts, start):
+            self.widget.mark_set(f"msg{index}", f"{line}.0")
+            self.widget.mark_gravity(f"msg{index}", tk.LEFT)
+            line += text.count("\n")
+        self.widget.mark_set(f"msg{self.first}", f"{line}.0")
+        self.widget.configure(state='disabled')
+        self.widget.yview(f"msg{self.first}")
+        self.first = start
+
+    def clear(self):
+        self.widget.configure(state='normal')
+        self.widget.delete("1.0", tk.END)
+        for mark in self.widget.mark_names():
+            if mark.startswith("msg"):
+                self.widget.mark_unset(mark)
+        self.widget.configure(state='disabled')
+        self.records = []
+        self.first = 0
+        self.end = 0
+        self.tail_parts = 0
+        self.tail_closed = False
+        self.loading = None
+        self.open = None
+        self.held = []
+        self.finished = None
+
+class ChatSession:
+    # One conversation tab: its history, chat pane and job key on the request engine. A dehydrated session
+    # keeps only its conversation id; the messages are read back from the store when its tab is selected.
+    def __init__(self, key, frame, renderer):
+        self.key = key
+        self.frame = frame
+        self.renderer = renderer
+        self.history = None
+        self.last_saved_index = 0
+        self.current_conversation = None
+        self.first_prompt = None
+        self.is_processing = False
+        self.hydrating = False
+        self.changed = False        # saved since the Markdown copy was last exported
+        self.last_selected = 0
+        self.render_seconds_at_send = 0.0
+        self.draft = ""
+
+    @property
+    def dehydrated(self):
+        return self.history is None
+
+    def title(self):
+        if not self.current_conversation:
+            return "新しい会話"
+        # Conversation ids are 会話履歴_<date>_<time>_<first prompt>
+        name = self.current_conversation.split("_", 3)[-1] or self.current_conversation
+        return name if len(name) <= 20 else name[:19] + "…"
 
 class ChatApp:
-    def __init__(self, master):
+    # Typing pause after which the draft is prepared for sending
+    PREWARM_IDLE_MS = 300
+    CHAT_LABELS = {"user": "あなた: ", "assistant": "AI: "}
+
+    def __init__(self, master, settings=None):
         self.master = master
         master.title("KizawaGPT")
         
-        self.load_settings()
+        if settings is None:
+            self.load_settings()
+        else:
+            self.settings = settings
         self.load_window_state()
+        self.ui_queue = queue.Queue()
+        # All writes (and reads that must see them) go through this thread, never the Tk thread
+        self.persistence = PersistenceWorker()
+        STARTUP.mark("settings")
         
         self.setup_ui()
-        self.setup_openai()
-        
-        self.conversation_history = [
-            {"role": "system", "content": "You are a helpful assistant."}
-        ]
+        STARTUP.mark("build window")
         
-        self.is_processing = False
-        self.last_saved_index = 0
-        self.current_filename = None
-        self.first_prompt = None
+        self.status_parts = {}
+        self.turn_metrics = []
+        self.metrics_log = None
+        if self.settings["METRICS_LOG"]:
+            self.metrics_log = MetricsLog(
+                os.path.join(APP_FOLDER, self.settings["METRICS_LOG"]), self.settings["METRICS_LOG_MAX_BYTES"]
+            )
+        self.response_cache = open_response_cache(self.settings)
+        # The client is set by on_client_ready once the engine has created it
+        # Deltas are routed to their tab per request (see process_message)
+        self.runner = CompletionRunner(
+            self.settings, None, self.response_cache,
+            on_status=lambda key, text: self.ui_queue.put(("status", (key, text)))
+        )
+
+        self.keystrokes = 0
+        self.prewarm_timer = None
+        self.sessions = []
+        self.session = None
+        self.session_count = 0
+        self.selections = 0
 
         # Create the conversation history folder if it doesn't exist
-        self.history_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "会話履歴")
+        self.history_folder = history_folder(self.settings)
         os.makedirs(self.history_folder, exist_ok=True)
+        self.store = ConversationStore(self.history_folder, self.settings["HISTORY_FSYNC_SECONDS"])
+        self.search_index = SearchIndex(os.path.join(self.history_folder, "search_index.sqlite3"), self.store)
+        STARTUP.mark("history store")
+
+        # Tabs open at the last exit come back dehydrated; only the selected one is read from disk
+        for conversation_id in self.window_state.get("tabs", []):
+            if os.path.exists(self.store.path(conversation_id)):
+                self.add_session(conversation_id)
+        if not self.sessions:
+            self.add_session()
+        selected = self.window_state.get("selected_tab", 0)
+        self.select_session(self.sessions[selected if 0 <= selected < len(self.sessions) else 0])
+        # On the persistence worker, queued after the selected tab is read and before the index is closed at exit
+        self.persistence.submit(self.search_index.catch_up)
+        STARTUP.mark("tabs")
+
+        self.setup_openai()
+        self.master.after(self.settings["STREAM_FLUSH_MS"], self.flush_ui_queue)
+        self.master.after_idle(self.on_window_shown)
 
     def load_settings(self):
-        default_settings = {
-            "AZURE_OPENAI_KEY": "your_default_key",
-            "AZURE_OPENAI_ENDPOINT": "your_default_endpoint",
-            "DEPLOYMENT_NAME": "your_default_deployment_name",
-            "MAX_TOKENS": 2000,
-            "TEMPERATURE": 0.7
-        }
-        try:
-            with open('setting.json', 'r') as f:
-                loaded_settings = json.load(f)
-                # Update default settings with loaded settings
-                self.settings = {**default_settings, **loaded_settings}
-        except (FileNotFoundError, json.JSONDecodeError):
-            print("Error: setting.json file not found or invalid format. Using default settings.")
-            self.settings = default_settings
+        self.settings = load_settings()
 
     def load_window_state(self):
         try:
@@ -60,8 +1907,11 @@ class ChatApp:
 
     def save_window_state(self):
         self.window_state["geometry"] = self.master.geometry()
-        with open('work.json', 'w') as f:
-            json.dump(self.window_state, f)
+        saved = [session for session in self.sessions if session.current_conversation]
+        self.window_state["tabs"] = [session.current_conversation for session in saved]
+        self.window_state["selected_tab"] = saved.index(self.session) if self.session in saved else 0
+        state = dict(self.window_state)
+        self.persistence.replace('work.json', lambda: [json.dumps(state)])
 
     def setup_ui(self):
         self.master.geometry(self.window_state["geometry"])
@@ -70,8 +1920,20 @@ class ChatApp:
         main_frame = tk.Frame(self.master)
         main_frame.pack(fill=tk.BOTH, expand=True)
 
-        self.chat_history = scrolledtext.ScrolledText(main_frame, state='disabled', height=20)
-        self.chat_history.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        search_frame = tk.Frame(main_frame)
+        search_frame.pack(fill=tk.X, padx=10, pady=(10, 0))
+
+        self.search_field = tk.Entry(search_frame)
+        self.search_field.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.search_field.bind("<Return>", lambda event: self.search_history())
+
+        self.search_button = tk.Button(search_frame, text="履歴を検索", command=self.search_history)
+        self.search_button.pack(side=tk.LEFT, padx=(10, 0))
+
+        # One tab per open conversation; the chat panes are added by add_session
+        self.notebook = ttk.Notebook(main_frame)
+        self.notebook.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
 
         bottom_frame = tk.Frame(main_frame)
         bottom_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
@@ -80,6 +1942,8 @@ class ChatApp:
         self.input_field.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
         self.input_field.bind("<Control-Return>", self.send_message_event)
+        self.input_field.bind("<FocusIn>", lambda event: self.prewarm())
+        self.input_field.bind("<KeyRelease>", self.on_input_key)
 
         button_frame = tk.Frame(bottom_frame)
         button_frame.pack(side=tk.RIGHT, padx=(10, 0))
@@ -87,6 +1951,9 @@ class ChatApp:
         self.send_button = tk.Button(button_frame, text="送信", command=self.send_message)
         self.send_button.pack(fill=tk.X)
 
+        self.stop_button = tk.Button(button_frame, text="停止", command=self.stop_message)
+        self.stop_button.pack(fill=tk.X, pady=(10, 0))
+
         self.continue_button = tk.Button(button_frame, text="続き", command=self.send_continue_message)
         self.continue_button.pack(fill=tk.X, pady=(10, 0))
 
@@ -96,209 +1963,721 @@ class ChatApp:
         self.load_history_button = tk.Button(button_frame, text="会話履歴読み込み", command=self.load_chat_history)
         self.load_history_button.pack(fill=tk.X, pady=(10, 0))
 
+        self.attach_button = tk.Button(button_frame, text="ファイルを添付", command=self.attach_file)
+        self.attach_button.pack(fill=tk.X, pady=(10, 0))
+
         self.view_history_button = tk.Button(button_frame, text="会話履歴を見る", command=self.view_chat_history)
         self.view_history_button.pack(fill=tk.X, pady=(10, 0))
 
+        self.new_tab_button = tk.Button(button_frame, text="新しいタブ", command=self.new_tab)
+        self.new_tab_button.pack(fill=tk.X, pady=(10, 0))
+
+        self.close_tab_button = tk.Button(button_frame, text="タブを閉じる", command=self.close_tab)
+        self.close_tab_button.pack(fill=tk.X, pady=(10, 0))
+
         self.clear_button = tk.Button(button_frame, text="会話をクリア", command=self.clear_conversation)
         self.clear_button.pack(fill=tk.X, pady=(10, 0))
 
         self.exit_button = tk.Button(button_frame, text="終了", command=self.on_closing)
         self.exit_button.pack(fill=tk.X, pady=(10, 0))
 
-        self.progress_bar = ttk.Progressbar(main_frame, mode='indeterminate')
-        self.progress_bar.pack(fill=tk.X, padx=10, pady=(0, 10))
+        status_frame = tk.Frame(main_frame)
+        status_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+
+        self.status_label = tk.Label(status_frame, anchor=tk.W)
+        self.status_label.pack(side=tk.LEFT)
+
+        self.progress_bar = ttk.Progressbar(status_frame, mode='indeterminate')
+        self.progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(10, 0))
+
+        self.stats_button = tk.Button(status_frame, text="統計 ▸", command=self.toggle_stats_panel)
+        self.stats_button.pack(side=tk.LEFT, padx=(10, 0))
+
+        # Collapsible panel with the timings of the last turn; hidden until 統計 is pressed
+        self.stats_frame = tk.Frame(main_frame)
+        self.stats_label = tk.Label(self.stats_frame, anchor=tk.W, justify=tk.LEFT, text="まだ計測結果はありません。")
+        self.stats_label.pack(fill=tk.X)
 
     def setup_openai(self):
-        self.client = AzureOpenAI(
-            api_key=self.settings["AZURE_OPENAI_KEY"],
-            api_version="2023-05-15",
-            azure_endpoint=self.settings["AZURE_OPENAI_ENDPOINT"]
+        self.engine = RequestEngine(self.settings, on_ready=self.on_client_ready)
+        self.ui_queue.put(("status", ("startup", "接続を準備中…")))
+
+    def on_window_shown(self):
+        # Importing the SDK starts only after the window has been drawn; messages sent meanwhile are queued
+        STARTUP.mark("window shown")
+        self.engine.start()
+
+    def on_client_ready(self, engine):
+        # Runs on the engine thread before any queued request
+        if not engine.startup_error:
+            try:
+                self.runner.scheduler.connect(engine.http_client)
+            except Exception as e:
+                engine.startup_error = e
+        if engine.startup_error:
+            self.ui_queue.put(("status", ("startup", f"APIクライアントを作成できませんでした: {engine.startup_error}")))
+            return
+        self.runner.token_counter.load_encoding()
+        self.ui_queue.put(("status", ("startup", "")))
+
+    def add_session(self, conversation_id=None):
+        # Without conversation_id a new, empty conversation; with it a dehydrated tab for a saved one
+        self.session_count += 1
+        frame = tk.Frame(self.notebook)
+        chat_history = scrolledtext.ScrolledText(frame, state='disabled', height=20)
+        chat_history.pack(fill=tk.BOTH, expand=True)
+        renderer = ChatRenderer(
+            chat_history, self.settings["CHAT_RENDER_WINDOW"], self.settings["CHAT_RENDER_PAGE"],
+            lambda messages: self.persistence.submit(self.read_older, session, messages)
         )
+        session = ChatSession(f"session{self.session_count}", frame, renderer)
+        if conversation_id:
+            session.current_conversation = conversation_id
+            session.first_prompt = conversation_id
+        else:
+            session.history = self.new_history()
+            session.history.append("system", self.settings["SYSTEM_PROMPT"])
+        self.sessions.append(session)
+        self.notebook.add(frame, text=session.title())
+        return session
+
+    def session_for(self, tab):
+        return next((session for session in self.sessions if str(session.frame) == str(tab)), None)
+
+    def on_tab_changed(self, event):
+        session = self.session_for(self.notebook.select())
+        if session:
+            self.select_session(session)
+
+    def select_session(self, session):
+        if session is self.session:
+            # Reselecting a tab whose messages could not be read tries again
+            if session.dehydrated:
+                self.hydrate(session)
+            return
+        if self.session:
+            self.session.draft = self.input_field.get("1.0", "end-1c")
+        self.session = session
+        self.selections += 1
+        session.last_selected = self.selections
+        if str(self.notebook.select()) != str(session.frame):
+            self.notebook.select(session.frame)
+        self.input_field.delete("1.0", tk.END)
+        self.input_field.insert("1.0", session.draft)
+        session.draft = ""
+        if session.is_processing:
+            self.progress_bar.start()
+        else:
+            self.progress_bar.stop()
+        if session.dehydrated:
+            self.hydrate(session)
+        self.dehydrate_idle_sessions()
+
+    def update_tab_title(self, session):
+        self.notebook.tab(session.frame, text=session.title())
+
+    def new_tab(self):
+        self.select_session(self.add_session())
+
+    def close_tab(self):
+        session = self.session
+        if session.is_processing:
+            return
+        if not session.dehydrated:
+            self.save_conversation(session)
+        self.finish_conversation(session)
+        self.sessions.remove(session)
+        self.session = None
+        self.notebook.forget(session.frame)
+        session.frame.destroy()
+        if not self.sessions:
+            self.add_session()
+        self.select_session(max(self.sessions, key=lambda other: other.last_selected))
+
+    def hydrate(self, session):
+        # The messages are read on the persistence worker, after any write still queued for them
+        if session.hydrating:
+            return
+        session.hydrating = True
+        session.renderer.clear()
+        self.update_chat_history("会話を読み込み中…\n", "system", session)
+        self.persistence.submit(self.read_session, session)
+
+    def read_session(self, session):
+        # Runs on the persistence worker
+        try:
+            self.ui_queue.put(("hydrate", (session, self.store.load(session.current_conversation))))
+        except Exception as e:
+            # Stays dehydrated; sending from the tab or selecting it again retries
+            self.ui_queue.put(("hydrate", (session, None)))
+            self.ui_queue.put(("message", (
+                session, f"ファイルの読み込み中にエラーが発生しました: {str(e)}\n"
+                         "送信ボタン（Ctrl+Enter）を押すと再読み込みします。\n", "error"
+            )))
+
+    def dehydrate_idle_sessions(self):
+        # Only the most recently selected tabs keep their messages in memory
+        loaded = [session for session in self.sessions if not session.dehydrated]
+        loaded.sort(key=lambda session: session.last_selected, reverse=True)
+        for session in loaded[max(self.settings["HYDRATED_TABS"], 1):]:
+            self.dehydrate(session)
+
+    def dehydrate(self, session):
+        # A tab can let go of its messages once they are all in the store; busy or unsaved tabs stay loaded
+        if session is self.session or session.is_processing or not session.current_conversation:
+            return
+        self.save_conversation(session)
+        session.history = None
+        session.last_saved_index = 0
+        session.renderer.clear()
 
     def send_message_event(self, event):
         self.send_message()
 
+    def on_input_key(self, event):
+        self.keystrokes += 1
+        if self.settings["PREWARM_KEYSTROKES"] and self.keystrokes % self.settings["PREWARM_KEYSTROKES"] == 0:
+            self.prewarm()
+        if self.prewarm_timer:
+            self.master.after_cancel(self.prewarm_timer)
+        self.prewarm_timer = self.master.after(self.PREWARM_IDLE_MS, self.prewarm)
+
+    def prewarm(self):
+        # Runs ahead of Ctrl+Enter: the request for the current draft is fitted and connections are opened
+        self.prewarm_timer = None
+        session = self.session
+        if not self.settings["PREWARM"] or session.is_processing or session.dehydrated:
+            return
+        messages = list(session.history.messages)
+        draft = self.input_field.get("1.0", tk.END).strip()
+        if draft:
+            messages.append({"role": "user", "content": draft})
+        self.engine.submit("prewarm", self.runner.prewarm(messages))
+
     def send_message(self):
-        if self.is_processing:
+        session = self.session
+        if session.dehydrated:
+            # The conversation failed to load; the draft is kept for when it has
+            self.hydrate(session)
+            return
+        if session.is_processing:
             return
 
         user_input = self.input_field.get("1.0", tk.END).strip()
         if user_input:
-            if not self.first_prompt:
-                self.first_prompt = user_input
-                self.current_filename = self.generate_filename()
-            self.update_chat_history(f"あなた: {user_input}\n", "user")
+            if not session.first_prompt:
+                session.first_prompt = user_input
+                session.current_conversation = self.generate_conversation_id(session)
+                self.update_tab_title(session)
             self.input_field.delete("1.0", tk.END)
-            self.conversation_history.append({"role": "user", "content": user_input})
+            self.show_message(session, session.history.append("user", user_input))
 
-            self.is_processing = True
+            session.is_processing = True
             self.progress_bar.start()
+            session.render_seconds_at_send = session.renderer.redraw_seconds
             
-            threading.Thread(target=self.process_message).start()
+            self.engine.submit(session.key, self.process_message(session))
 
-    def process_message(self):
+    def stop_message(self):
+        self.engine.cancel(self.session.key)
+
+    async def process_message(self, session):
+        stream = self.settings["STREAM"]
+        reply = []
+        metrics = TurnMetrics()
+        outcome = "error"
+        # The history belongs to the Tk thread; the reply is handed back through the queue, tagged with its tab
         try:
-            response = self.client.chat.completions.create(
-                model=self.settings["DEPLOYMENT_NAME"],
-                messages=self.conversation_history,
-                max_tokens=self.settings["MAX_TOKENS"],
-                temperature=self.settings["TEMPERATURE"],
-                stop=None
+            if self.engine.startup_error:
+                raise self.engine.startup_error
+            if stream:
+                self.ui_queue.put(("begin", (session, "assistant")))
+                self.ui_queue.put(("delta", (session, "AI: ")))
+            # A copy: the Tk thread keeps appending to the history while this request is fitted
+            await self.runner.complete(
+                list(session.history.messages), stream, reply, metrics,
+                on_delta=lambda delta: self.ui_queue.put(("delta", (session, delta)))
             )
-            ai_response = response.choices[0].message.content
-            
-            # 応答の連続性をチェック
-            if ai_response.strip().endswith(('。', '．', '.', '!', '?', '：', ':', ';', '；')):
-                full_response = ai_response
+            full_response = "".join(reply)
+
+            if stream:
+                self.ui_queue.put(("end", (session, "\n")))
             else:
-                # 応答が途中で切れている可能性がある場合、続きを要求
-                self.conversation_history.append({"role": "assistant", "content": ai_response})
-                self.conversation_history.append({"role": "user", "content": "続きをお願いします。"})
-                
-                # 続きの応答を取得
-                continuation_response = self.client.chat.completions.create(
-                    model=self.settings["DEPLOYMENT_NAME"],
-                    messages=self.conversation_history,
-                    max_tokens=self.settings["MAX_TOKENS"],
-                    temperature=self.settings["TEMPERATURE"]
-                )
-                continuation = continuation_response.choices[0].message.content
-                
-                full_response = ai_response + "\n" + continuation
-
-            self.master.after(0, self.update_chat_history, f"AI: {full_response}\n", "assistant")
-            self.conversation_history.append({"role": "assistant", "content": full_response})
-            self.save_conversation()
+                self.ui_queue.put(("begin", (session, "assistant")))
+                self.ui_queue.put(("end", (session, f"AI: {full_response}\n")))
+            self.ui_queue.put(("reply", (session, full_response, metrics)))
+            outcome = "ok"
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            # Keep what was received so far so the conversation stays consistent
+            partial = "".join(reply)
+            if stream:
+                self.ui_queue.put(("end", (session, "\n")))
+            elif partial:
+                self.ui_queue.put(("begin", (session, "assistant")))
+                self.ui_queue.put(("end", (session, f"AI: {partial}\n")))
+            if partial:
+                self.ui_queue.put(("reply", (session, partial, metrics)))
+            self.ui_queue.put(("message", (session, "応答の生成を中断しました。\n", "system")))
+            raise
         except Exception as e:
-            self.master.after(0, self.update_chat_history, f"エラーが発生しました: {str(e)}\n", "error")
+            if stream:
+                self.ui_queue.put(("end", (session, "\n")))
+            self.ui_queue.put(("message", (session, f"エラーが発生しました: {str(e)}\n", "error")))
         finally:
-            self.is_processing = False
-            self.master.after(0, self.progress_bar.stop)
+            metrics.finish()
+            self.ui_queue.put(("metrics", (session, metrics, outcome)))
+            # Routed through the queue so the reply is fully drawn before the next send
+            self.ui_queue.put(("done", session))
+
+    def report_metrics(self, session, metrics, outcome):
+        # Render time is measured on the Tk thread, so it is added once the reply is on screen
+        renderer = session.renderer
+        if renderer.redraw_pending:
+            renderer.redraw()
+        metrics.add("render", renderer.redraw_seconds - session.render_seconds_at_send)
+        # Queued behind the save of the reply, so the record includes its time
+        self.persistence.submit(self.record_metrics, metrics, outcome)
+
+    def record_metrics(self, metrics, outcome):
+        # Runs on the persistence worker
+        record = metrics.record()
+        record["outcome"] = outcome
+        if self.metrics_log:
+            self.metrics_log.write(record)
+        self.ui_queue.put(("stats", record))
+
+    def show_metrics(self, record):
+        self.turn_metrics.append(record)
+        del self.turn_metrics[:-100]
+        self.update_stats_panel()
+
+    def update_stats_panel(self):
+        if not self.turn_metrics:
+            return
+        last = self.turn_metrics[-1]
+        stages = last["stages_ms"]
+        labels = [("prepare", "準備"), ("queue", "待機"), ("network", "通信"), ("backoff", "再試行待ち"),
+                  ("generation", "生成"), ("render", "描画"), ("save", "保存")]
+        lines = [
+            f"直近: 合計 {last['total_ms']:.0f} ms  初回トークン {last['first_token_ms'] or 0:.0f} ms  ({last['outcome']})",
+            "  ".join(f"{label} {stages.get(stage, 0):.0f}" for stage, label in labels) + " ms",
+        ]
+        continuation = sum(ms for stage, ms in stages.items() if stage.startswith("continuation."))
+        if continuation:
+            lines.append(f"続きの要求: {continuation:.0f} ms")
+        estimated = "（推定）" if last["usage_estimated"] else ""
+        lines.append(f"トークン: 入力 {last['prompt_tokens']}（うちキャッシュ済み {last['cached_tokens']}）"
+                     f" / 出力 {last['completion_tokens']}{estimated}"
+                     f"  キャッシュ {last['cache_hits']}  再試行 {last['retries']}")
+        count = len(self.turn_metrics)
+        average_total = sum(m["total_ms"] for m in self.turn_metrics) / count
+        first_tokens = [m["first_token_ms"] for m in self.turn_metrics if m["first_token_ms"] is not None]
+        average_first = sum(first_tokens) / len(first_tokens) if first_tokens else 0
+        lines.append(f"平均（{count} ターン）: 合計 {average_total:.0f} ms  初回トークン {average_first:.0f} ms")
+        endpoints = self.runner.scheduler.endpoints
+        if len(endpoints) > 1:
+            lines.extend(describe_endpoint(endpoint) for endpoint in endpoints)
+        self.stats_label.configure(text="\n".join(lines))
+
+    def toggle_stats_panel(self):
+        if self.stats_frame.winfo_ismapped():
+            self.stats_frame.pack_forget()
+            self.stats_button.configure(text="統計 ▸")
+        else:
+            self.stats_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+            self.stats_button.configure(text="統計 ▾")
+
+    def flush_ui_queue(self):
+        self.handle_ui_events()
+        self.master.after(self.settings["STREAM_FLUSH_MS"], self.flush_ui_queue)
+
+    def handle_ui_events(self):
+        # Coalesce consecutive deltas so a burst of tokens costs a single insert per tab
+        pending = {}
+        try:
+            while True:
+                kind, payload = self.ui_queue.get_nowait()
+                if kind == "delta":
+                    session, text = payload
+                    pending.setdefault(session, []).append(text)
+                    continue
+                if pending:
+                    self.flush_deltas(pending)
+                if kind == "begin":
+                    session, role = payload
+                    session.renderer.begin(role)
+                elif kind == "end":
+                    session, text = payload
+                    session.renderer.end_message(text)
+                elif kind == "message":
+                    session, text, role = payload
+                    self.update_chat_history(text, role, session)
+                elif kind == "status":
+                    key, text = payload
+                    self.status_parts[key] = text
+                    self.status_label.configure(text="  ".join(text for text in self.status_parts.values() if text))
+                elif kind == "reply":
+                    self.add_reply(*payload)
+                elif kind == "restore":
+                    self.open_conversation(*payload)
+                elif kind == "hydrate":
+                    session, messages = payload
+                    if messages is None:
+                        session.hydrating = False
+                    elif session in self.sessions:
+                        self.restore_conversation(session, session.current_conversation, messages, announce=False)
+                elif kind == "older":
+                    session, messages, texts = payload
+                    session.renderer.show_older(messages, texts)
+                elif kind == "attach":
+                    self.start_attachment(self.session, payload)
+                elif kind == "attachment":
+                    self.add_attachment(*payload)
+                elif kind == "search_results":
+                    self.show_search_results(*payload)
+                elif kind == "metrics":
+                    self.report_metrics(*payload)
+                elif kind == "stats":
+                    self.show_metrics(payload)
+                elif kind == "done":
+                    payload.is_processing = False
+                    if payload is self.session:
+                        self.progress_bar.stop()
+                    # A tab that finished in the background can now be dehydrated
+                    self.dehydrate_idle_sessions()
+        except queue.Empty:
+            pass
+        if pending:
+            self.flush_deltas(pending)
+
+    def flush_deltas(self, pending):
+        for session, texts in pending.items():
+            session.renderer.append("".join(texts))
+        pending.clear()
+
+    def add_reply(self, session, content, metrics):
+        # The reply is already on screen (streamed or not, it went through begin/end); its record now reads
+        # the text from the conversation
+        renderer = session.renderer
+        renderer.link(renderer.finished, session.history.append("assistant", content), self.CHAT_LABELS["assistant"])
+        self.save_conversation(session, metrics)
 
     def send_continue_message(self):
-        if not self.is_processing:
+        session = self.session
+        if not session.is_processing and not session.dehydrated:
             continue_message = "続きをお願いします"
-            self.update_chat_history(f"あなた: {continue_message}\n", "user")
-            self.conversation_history.append({"role": "user", "content": continue_message})
+            self.show_message(session, session.history.append("user", continue_message))
             self.send_message()
 
     def load_latest_chat(self):
+        self.persistence.submit(self.read_latest_chat)
+
+    def read_latest_chat(self):
+        # Runs on the persistence worker, after every queued write
+        conversation_id = self.store.latest()
+        if conversation_id:
+            self.ui_queue.put(("restore", (conversation_id, self.store.load(conversation_id))))
+            return
         try:
             with open('latest_chat.md', 'r', encoding='utf-8') as f:
-                content = f.read()
-            self.input_field.delete("1.0", tk.END)
-            self.input_field.insert(tk.END, content)
-            self.send_message()
+                messages = parse_markdown(f.read())
+            self.ui_queue.put(("restore", (None, messages)))
         except FileNotFoundError:
-            self.update_chat_history("最新の会話ファイルが見つかりません。\n", "system")
+            self.ui_queue.put(("message", (None, "最新の会話ファイルが見つかりません。\n", "system")))
 
     def load_chat_history(self):
         file_path = filedialog.askopenfilename(
             initialdir=self.history_folder,
             title="会話履歴を選択",
-            filetypes=[("Markdown files", "*.md"), ("Text files", "*.txt"), ("All files", "*.*")]
+            filetypes=[("Conversation files", "*.jsonl"), ("Markdown files", "*.md"), ("Text files", "*.txt"), ("All files", "*.*")]
         )
         if file_path:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                self.input_field.delete("1.0", tk.END)
-                self.input_field.insert(tk.END, content)
-                self.send_message()
-            except Exception as e:
-                self.update_chat_history(f"ファイルの読み込み中にエラーが発生しました: {str(e)}\n", "error")
+            self.persistence.submit(self.read_chat_file, file_path)
+
+    def read_chat_file(self, file_path):
+        # Runs on the persistence worker
+        try:
+            name, extension = os.path.splitext(os.path.basename(file_path))
+            if extension == ".jsonl" and os.path.samefile(os.path.dirname(file_path), self.history_folder):
+                self.ui_queue.put(("restore", (name, self.store.load(name))))
+                return
+            if not is_conversation_file(file_path):
+                # Anything else is summarized as an attachment instead of being pasted into the input field
+                self.ui_queue.put(("attach", file_path))
+                return
+            with open(file_path, 'r', encoding='utf-8') as f:
+                messages = parse_markdown(f.read())
+            self.ui_queue.put(("restore", (None, messages)))
+        except Exception as e:
+            self.ui_queue.put(("message", (None, f"ファイルの読み込み中にエラーが発生しました: {str(e)}\n", "error")))
+
+    def attach_file(self):
+        if self.session.is_processing or self.session.dehydrated:
+            return
+        file_path = filedialog.askopenfilename(title="添付するファイルを選択", filetypes=[("All files", "*.*")])
+        if file_path:
+            self.start_attachment(self.session, file_path)
+
+    def start_attachment(self, session, file_path):
+        if session.is_processing or session.dehydrated:
+            return
+        self.update_chat_history(f"添付ファイル「{os.path.basename(file_path)}」を分割して要約します。\n", "system", session)
+        session.is_processing = True
+        if session is self.session:
+            self.progress_bar.start()
+        self.engine.submit(session.key, self.process_attachment(session, file_path))
+
+    async def process_attachment(self, session, file_path):
+        summarizer = AttachmentSummarizer(
+            self.settings, self.runner, on_progress=lambda text: self.ui_queue.put(("status", ("attachment", text)))
+        )
+        try:
+            if self.engine.startup_error:
+                raise self.engine.startup_error
+            result = await summarizer.summarize(file_path)
+            self.ui_queue.put(("attachment", (session, file_path, result)))
+        except asyncio.CancelledError:
+            self.ui_queue.put(("message", (session, "添付ファイルの要約を中断しました。\n", "system")))
+            raise
+        except Exception as e:
+            self.ui_queue.put(("message", (session, f"添付ファイルの要約中にエラーが発生しました: {str(e)}\n", "error")))
+        finally:
+            self.ui_queue.put(("status", ("attachment", "")))
+            self.ui_queue.put(("done", session))
+
+    def add_attachment(self, session, file_path, result):
+        # Only the summary enters the conversation and the chat pane, never the file itself
+        name = os.path.basename(file_path)
+        content = f"添付ファイル「{name}」の要約（{result['chunks']} チャンク）:\n{result['summary']}"
+        if not session.first_prompt:
+            session.first_prompt = name
+            session.current_conversation = self.generate_conversation_id(session)
+            self.update_tab_title(session)
+        self.show_message(session, session.history.append("user", content))
+        self.save_conversation(session)
+
+    def open_conversation(self, conversation_id, messages):
+        # A conversation already open in a tab is selected there; otherwise it replaces an empty current tab
+        # or opens in a new one
+        for session in self.sessions:
+            if conversation_id and session.current_conversation == conversation_id:
+                self.select_session(session)
+                return
+        session = self.session
+        if session.is_processing or session.dehydrated or len(session.history.messages) > 1:
+            session = self.add_session()
+        self.restore_conversation(session, conversation_id, messages)
+        self.select_session(session)
+
+    def restore_conversation(self, session, conversation_id, messages, announce=True):
+        # Restores roles as they were saved; nothing is sent until the user writes the next message
+        history = self.new_history(conversation_id)
+        if not messages or messages[0]["role"] != "system":
+            history.append("system", self.settings["SYSTEM_PROMPT"])
+        session.renderer.clear()
+        self.runner.token_counter.clear()
+        for position, entry in enumerate(messages):
+            # Messages from the conversation file can be spilled back to it right away
+            message = history.append(entry["role"], entry["content"], position if conversation_id else None)
+            if message.role in self.CHAT_LABELS:
+                self.show_message(session, message)
+        session.history = history
+        session.hydrating = False
+        history.spill()
+        if announce:
+            self.update_chat_history(
+                f"会話を読み込みました（{len(history.messages)} 件のメッセージ）。\n", "system", session
+            )
+        if conversation_id:
+            session.current_conversation = conversation_id
+            session.first_prompt = conversation_id
+            session.last_saved_index = len(history.messages)
+        else:
+            # Imported from Markdown: saved as a new conversation on the next reply
+            session.current_conversation = None
+            session.first_prompt = None
+            session.last_saved_index = 0
+        self.update_tab_title(session)
+
+    def read_older(self, session, messages):
+        # Runs on the persistence worker: texts spilled from memory, for messages scrolled back into view
+        try:
+            texts = message_texts(messages)
+        except Exception as e:
+            print(f"Error: could not read older messages: {e}")
+            texts = None
+        self.ui_queue.put(("older", (session, messages, texts)))
+
+    def search_history(self):
+        self.persistence.submit(self.run_search, self.search_field.get())
+
+    def run_search(self, query):
+        # Runs on the persistence worker, so messages saved just before are found too
+        try:
+            results = self.search_index.search(query)
+        except Exception as e:
+            self.ui_queue.put(("message", (None, f"履歴の検索中にエラーが発生しました: {str(e)}\n", "error")))
+            return
+        self.ui_queue.put(("search_results", (query, results)))
+
+    def show_search_results(self, query, results):
+        window = tk.Toplevel(self.master)
+        window.title(f"検索結果: {query}（{len(results)} 件）")
+        window.geometry("600x300")
+        listbox = tk.Listbox(window)
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        roles = {"system": "システム", "user": "あなた", "assistant": "AI"}
+        for conversation_id, position, role, snippet in results:
+            snippet = snippet.replace("\n", " ")
+            listbox.insert(tk.END, f"{conversation_id} [{roles.get(role, role)}] {snippet}")
+
+        def open_result(event):
+            selection = listbox.curselection()
+            if selection:
+                conversation_id = results[selection[0]][0]
+                self.persistence.submit(self.read_conversation, conversation_id)
+                window.destroy()
+
+        listbox.bind("<Double-Button-1>", open_result)
+
+    def read_conversation(self, conversation_id):
+        try:
+            self.ui_queue.put(("restore", (conversation_id, self.store.load(conversation_id))))
+        except Exception as e:
+            self.ui_queue.put(("message", (None, f"ファイルの読み込み中にエラーが発生しました: {str(e)}\n", "error")))
 
     def view_chat_history(self):
         try:
             if os.name == 'nt':  # Windows
                 os.startfile(self.history_folder)
-            elif os.name == 'posix':  # macOS and Linux
+            elif sys.platform == 'darwin':  # macOS
                 subprocess.call(['open', self.history_folder])
+            elif os.name == 'posix':  # Linux
+                subprocess.call(['xdg-open', self.history_folder])
             else:
                 raise OSError("Unsupported operating system")
         except Exception as e:
             self.update_chat_history(f"会話履歴フォルダを開く際にエラーが発生しました: {str(e)}\n", "error")
 
-    def update_chat_history(self, message, role):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        divider = "-" * 50 + "\n"
+    def update_chat_history(self, message, role, session=None):
+        # Without a session the text goes to the selected tab
+        renderer = (session or self.session).renderer
+        return renderer.add(role, message)
 
-        self.chat_history.configure(state='normal')
-        self.chat_history.insert(tk.END, f"{timestamp} - {role}\n")
-        self.chat_history.insert(tk.END, message)
-        self.chat_history.insert(tk.END, divider)
-        self.chat_history.configure(state='disabled')
-        self.chat_history.see(tk.END)
+    def show_message(self, session, message):
+        label = self.CHAT_LABELS[message.role]
+        record = self.update_chat_history(f"{label}{message.content}\n", message.role, session)
+        session.renderer.link(record, message, label)
 
     def clear_conversation(self):
-        self.conversation_history = [
-            {"role": "system", "content": "You are a helpful assistant."}
-        ]
-        self.chat_history.configure(state='normal')
-        self.chat_history.delete("1.0", tk.END)
-        self.chat_history.configure(state='disabled')
-        self.update_chat_history("会話がクリアされました。新しい会話を開始します。\n", "system")
-        self.last_saved_index = 0
-        self.first_prompt = None
-        self.current_filename = None
+        session = self.session
+        if session.is_processing or session.hydrating:
+            return
+        self.finish_conversation(session)
+        session.history = self.new_history()
+        session.history.append("system", self.settings["SYSTEM_PROMPT"])
+        session.renderer.clear()
+        self.runner.token_counter.clear()
+        self.update_chat_history("会話がクリアされました。新しい会話を開始します。\n", "system", session)
+        session.last_saved_index = 0
+        session.first_prompt = None
+        session.current_conversation = None
+        self.update_tab_title(session)
 
-    def generate_filename(self):
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        sanitized_prompt = re.sub(r'[^\w\s-]', '', self.first_prompt)
-        sanitized_prompt = sanitized_prompt.strip()[:30]
-        sanitized_prompt = re.sub(r'\s+', '_', sanitized_prompt)
-        return os.path.join(self.history_folder, f"会話履歴_{timestamp}_{sanitized_prompt}.md")
+    def finish_conversation(self, session):
+        # Markdown copies are exports of the store, written when a conversation is left (closed, cleared or
+        # at exit) and only if it changed, so dozens of open tabs do not rewrite their files on every exit
+        if session.current_conversation and session.changed:
+            session.changed = False
+            self.persistence.submit(self.export_conversation, session.current_conversation)
 
-    def save_conversation(self):
-        new_messages = self.conversation_history[self.last_saved_index:]
+    def export_conversation(self, conversation_id):
+        if os.path.exists(self.store.path(conversation_id)):
+            try:
+                self.store.export_markdown(conversation_id, self.store.path(conversation_id, ".md"))
+            except Exception as e:
+                print(f"Error: could not export conversation to Markdown: {e}")
+
+    def generate_conversation_id(self, session):
+        return make_conversation_id(session.first_prompt, self.store)
+
+    def new_history(self, conversation_id=None):
+        return ConversationHistory(self.store, self.settings["HISTORY_MEMORY_MB"] * 1024 * 1024, conversation_id)
+
+    def save_conversation(self, session, metrics=None):
+        history = session.history
+        new_messages = history.messages[session.last_saved_index:]
         if not new_messages:
             return
 
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        markdown_content = f"# 会話履歴 - {timestamp}\n\n"
-        
-        for entry in new_messages:
-            role = entry["role"]
-            content = entry["content"]
-            if role == "system":
-                markdown_content += f"**システム**: {content}\n\n"
-            elif role == "user":
-                markdown_content += f"**あなた**: {content}\n\n"
-            elif role == "assistant":
-                markdown_content += f"**AI**: {content}\n\n"
-            markdown_content += "---\n\n"
-        
-        if self.current_filename:
-            with open(self.current_filename, 'a', encoding="utf-8") as f:
-                f.write(markdown_content)
-        
-        self.last_saved_index = len(self.conversation_history)
+        if session.current_conversation:
+            conversation_id = session.current_conversation
+            session.changed = True
+            def write(messages):
+                # Timed on the worker, where the writing happens; the turn's metrics are reported after this
+                started = time.perf_counter()
+                start = record_messages(self.store, self.search_index, conversation_id, messages)
+                if metrics:
+                    metrics.add("save", time.perf_counter() - started)
+                # Once written, the messages may be spilled from memory
+                history.mark_saved(conversation_id, start, messages)
+
+            self.persistence.append(conversation_id, new_messages, write)
+
+        session.last_saved_index = len(history.messages)
 
     def save_latest_chat(self):
-        if not self.conversation_history:
+        if self.session.dehydrated:
+            return
+        messages = list(self.session.history.messages)
+        if not messages:
             return
 
-        markdown_content = "# 最新の会話\n\n"
-        for entry in self.conversation_history:
-            role = entry["role"]
-            content = entry["content"]
-            if role == "system":
-                markdown_content += f"**システム**: {content}\n\n"
-            elif role == "user":
-                markdown_content += f"**あなた**: {content}\n\n"
-            elif role == "assistant":
-                markdown_content += f"**AI**: {content}\n\n"
-            markdown_content += "---\n\n"
-
-        with open('latest_chat.md', 'w', encoding="utf-8") as f:
-            f.write(markdown_content)
+        # A shallow copy is enough: saved messages are never modified. Spilled texts are read back a page at a time.
+        page = TokenCounter.READ_PAGE
+        self.persistence.replace('latest_chat.md', lambda: itertools.chain(
+            ["# 最新の会話\n\n"],
+            itertools.chain.from_iterable(
+                iter_markdown(resolve_messages(messages[start:start + page])) for start in range(0, len(messages), page)
+            )
+        ))
 
     def on_closing(self):
+        self.engine.shutdown()
+        # Picks up a reply cut off by the shutdown so it is saved with the rest
+        self.handle_ui_events()
+        if self.response_cache:
+            self.response_cache.close()
         self.save_window_state()
         self.save_latest_chat()
+        for session in self.sessions:
+            self.finish_conversation(session)
+        self.persistence.submit(self.store.close)
+        self.persistence.submit(self.search_index.close)
+        if not self.persistence.close(self.settings["PERSIST_FLUSH_SECONDS"]):
+            print("Error: saving did not finish before the window was closed")
         self.master.destroy()
 
-if __name__ == "__main__":
+def main():
+    parser = argparse.ArgumentParser(description="KizawaGPT")
+    parser.add_argument("--batch", metavar="DIR", help="DIR 内のプロンプトファイル（.txt/.md）を画面なしで処理する")
+    parser.add_argument("--workers", type=int, default=4, help="同時に処理するプロンプト数")
+    parser.add_argument("--output", help="結果を追記するJSONLファイル（既定: DIR/results.jsonl）")
+    parser.add_argument("--startup-report", action="store_true", help="起動の各段階にかかった時間を標準エラーに表示する")
+    args = parser.parse_args()
+    STARTUP.enabled = args.startup_report
+    STARTUP.mark("import modules")
+
+    if args.batch:
+        output = args.output or os.path.join(args.batch, "results.jsonl")
+        runner = BatchRunner(load_settings(), args.batch, args.workers, output)
+        sys.exit(asyncio.run(runner.run()))
+
     root = tk.Tk()
+    STARTUP.mark("create Tk root")
     app = ChatApp(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
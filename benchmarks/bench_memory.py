@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from KizawaGPT import ContextWindow, ConversationHistory, ConversationStore, TokenCounter, resolve_messages
+
+# Memory held by a long conversation: the plain dict list the app used to keep, against ConversationHistory
+# with a resident-memory cap (older texts spilled to the conversation file). Also times fitting a request
+# and reading the sent messages back, which is what spilling costs on each turn.
+
+def make_text(index, chars):
+    # Every message is a distinct string, like text pasted or received over a long session
+    line = f"# message {index}: def handler_{index}(request): return process(request, option={index})\n"
+    return (line * (chars // len(line) + 1))[:chars]
+
+def build_dicts(count, chars):
+    roles = ["user", "assistant"]
+    # Roles are new string objects per message, as when read back with json.loads
+    return [{"role": "".join(roles[index % 2]), "content": make_text(index, chars)} for index in range(count)]
+
+def build_history(store, count, chars, memory_limit, save_every):
+    history = ConversationHistory(store, memory_limit)
+    history.append("system", "You are a helpful assistant.")
+    saved = 0
+    for index in range(count):
+        history.append("user" if index % 2 == 0 else "assistant", make_text(index, chars))
+        if len(history.messages) - saved >= save_every:
+            messages = history.messages[saved:]
+            store.append("bench", messages)
+            history.mark_saved("bench", saved, messages)
+            saved = len(history.messages)
+    return history
+
+def measure(build):
+    tracemalloc.start()
+    started = time.perf_counter()
+    value = build()
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, {"resident_mb": current / 1e6, "peak_mb": peak / 1e6, "build_seconds": elapsed}
+
+def time_turns(messages, budget, turns):
+    counter = TokenCounter()
+    window = ContextWindow(counter, budget)
+    samples = []
+    for turn in range(turns):
+        started = time.perf_counter()
+        fitted, stats = window.fit(messages + [{"role": "user", "content": f"question {turn}"}])
+        resolve_messages(fitted)
+        samples.append((time.perf_counter() - started) * 1000)
+    return {"first_turn_ms": samples[0], "later_turn_ms": sum(samples[1:]) / max(len(samples) - 1, 1),
+            "sent_messages": len(fitted)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory of a long conversation")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--message-chars", type=int, default=20000, help="length of each message (pasted code)")
+    parser.add_argument("--memory-mb", type=float, default=16, help="resident cap of ConversationHistory")
+    parser.add_argument("--budget", type=int, default=12000, help="CONTEXT_TOKEN_BUDGET used for the turns")
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="kizawagpt_bench_")
+    store = ConversationStore(folder, 60)
+    results = {}
+    try:
+        dicts, results["dicts"] = measure(lambda: build_dicts(args.messages, args.message_chars))
+        results["dicts"].update(time_turns(dicts, args.budget, args.turns))
+        del dicts
+        history, results["history"] = measure(lambda: build_history(
+            store, args.messages, args.message_chars, int(args.memory_mb * 1024 * 1024), 2
+        ))
+        results["history"].update(time_turns(history.messages, args.budget, args.turns))
+        results["history"]["resident_text_mb"] = history.resident_bytes / 1e6
+    finally:
+        store.close()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    for name, result in results.items():
+        print(f"{name}: resident {result['resident_mb']:.1f} MB (peak {result['peak_mb']:.1f} MB), "
+              f"first turn {result['first_turn_ms']:.1f} ms, later turns {result['later_turn_ms']:.1f} ms")
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import KizawaGPT
+from KizawaGPT import DEFAULT_SETTINGS, CompletionRunner, TurnMetrics
+from mock_server import MockOptions, start_mock_server
+
+# First turn after idle, with and without pre-warming while the user types. Each turn starts with an
+# empty connection pool (as after the pool's idle timeout); the mock charges connect_latency for every
+# new connection, like DNS/TCP/TLS to a real endpoint.
+
+def reconnect(runner):
+    http_client = KizawaGPT.import_openai().DefaultAsyncHttpxClient()
+    for endpoint in runner.scheduler.endpoints:
+        endpoint.client = None
+        endpoint.warmed = 0.0
+    runner.scheduler.connect(http_client)
+    return http_client
+
+async def turn(runner, history, text, prewarm, typing_pause):
+    http_client = reconnect(runner)
+    if prewarm:
+        await runner.prewarm(history + [{"role": "user", "content": text}])
+        await asyncio.sleep(typing_pause)
+    first_token = []
+    runner.on_delta = lambda delta: first_token.append(time.perf_counter())
+    metrics = TurnMetrics()
+    started = time.perf_counter()
+    await runner.complete(history + [{"role": "user", "content": text}], True, [], metrics)
+    await http_client.aclose()
+    return {"first_token_ms": (first_token[0] - started) * 1000,
+            "prepare_ms": metrics.stages.get("prepare", 0.0) * 1000}
+
+async def run(url, pinned_file, turns, history_size, typing_pause):
+    settings = {
+        **DEFAULT_SETTINGS,
+        "AZURE_OPENAI_KEY": "mock",
+        "AZURE_OPENAI_ENDPOINT": url,
+        "DEPLOYMENT_NAME": "mock",
+        "RESPONSE_CACHE": False,
+        "CONTEXT_TOKEN_BUDGET": 8000,
+        "PINNED_FILES": [pinned_file],
+    }
+    runner = CompletionRunner(settings)
+    history = [{"role": "system", "content": settings["SYSTEM_PROMPT"]}]
+    for index in range(history_size):
+        history.append({"role": "user" if index % 2 == 0 else "assistant",
+                        "content": f"これは過去のメッセージ {index} です。" * 10})
+    # Token counts of the existing history are already cached in a running app
+    runner.context_window.fit(history, runner.pinned.blocks())
+
+    results = {}
+    for mode in ("cold", "prewarmed"):
+        samples = [await turn(runner, history, f"{mode} の質問 {index}", mode == "prewarmed", typing_pause)
+                   for index in range(turns)]
+        results[mode] = {
+            key: sum(sample[key] for sample in samples) / len(samples) for key in ("first_token_ms", "prepare_ms")
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="First turn after idle with and without pre-warming")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--connect-latency", type=float, default=0.15, help="simulated DNS/TCP/TLS setup")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--history", type=int, default=2000, help="messages already in the conversation")
+    parser.add_argument("--pinned-chars", type=int, default=200000, help="size of the pinned reference file")
+    parser.add_argument("--typing-pause", type=float, default=0.3)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    server = start_mock_server(MockOptions(latency=args.latency, reply_tokens=20, connect_latency=args.connect_latency))
+    with tempfile.NamedTemporaryFile('w', suffix=".txt", encoding="utf-8", delete=False) as f:
+        f.write(("参考資料の本文です。" * args.pinned_chars)[:args.pinned_chars])
+    try:
+        results = asyncio.run(run(server.url, f.name, args.turns, args.history, args.typing_pause))
+    finally:
+        server.shutdown()
+        os.unlink(f.name)
+    results["server_connections"] = server.counters["connections"]
+    for mode in ("cold", "prewarmed"):
+        print(f"{mode}: first token {results[mode]['first_token_ms']:.1f} ms, "
+              f"local preparation {results[mode]['prepare_ms']:.2f} ms")
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
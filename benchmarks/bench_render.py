@@ -0,0 +1,60 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tkinter as tk
+from tkinter import scrolledtext
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from KizawaGPT import ChatRenderer
+
+# Appends messages to the chat pane and reports the average cost per append for each block,
+# once with the virtualized window and once with every message kept in the widget.
+
+def run(messages, block, window, message_text):
+    root = tk.Tk()
+    root.geometry("600x400")
+    widget = scrolledtext.ScrolledText(root, state='disabled', height=20)
+    widget.pack(fill=tk.BOTH, expand=True)
+    renderer = ChatRenderer(widget, window, 50)
+    root.update()
+
+    blocks = []
+    start = time.perf_counter()
+    for index in range(1, messages + 1):
+        renderer.begin("assistant")
+        renderer.end_message(f"AI: {message_text}\n")
+        renderer.redraw()
+        root.update_idletasks()
+        if index % block == 0:
+            elapsed = time.perf_counter() - start
+            blocks.append({"messages": index, "ms_per_append": elapsed / block * 1000})
+            start = time.perf_counter()
+    root.destroy()
+    return blocks
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat pane append cost benchmark")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--block", type=int, default=1000)
+    parser.add_argument("--window", type=int, default=200)
+    parser.add_argument("--message-chars", type=int, default=400)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    message_text = ("これはベンチマーク用のメッセージです。" * args.message_chars)[:args.message_chars]
+    results = {
+        "virtualized": run(args.messages, args.block, args.window, message_text),
+        "unbounded": run(args.messages, args.block, args.messages + 1, message_text),
+    }
+    for name, blocks in results.items():
+        print(name)
+        for entry in blocks:
+            print(f"  {entry['messages']:>6} messages: {entry['ms_per_append']:.3f} ms/append")
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
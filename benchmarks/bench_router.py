@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from KizawaGPT import DEFAULT_SETTINGS, CompletionRunner, describe_endpoint
+from mock_server import MockOptions, start_mock_server
+
+# Two local mock deployments with different speed and quota: compares sending everything to the first one
+# with routing across both, and reports how the router split the load.
+
+async def run(endpoints, requests, concurrency, max_tokens):
+    settings = {
+        **DEFAULT_SETTINGS,
+        "AZURE_OPENAI_KEY": "mock",
+        "DEPLOYMENT_NAME": "mock",
+        "MAX_TOKENS": max_tokens,
+        "MAX_CONTINUATIONS": 0,
+        "MAX_RETRIES": 20,
+        "RESPONSE_CACHE": False,
+        "ENDPOINTS": endpoints,
+    }
+    runner = CompletionRunner(settings)
+    runner.scheduler.connect()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(index):
+        async with semaphore:
+            started = time.perf_counter()
+            await runner.complete([{"role": "user", "content": f"benchmark request {index}"}], False, [])
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    for endpoint in runner.scheduler.endpoints:
+        print(f"  {describe_endpoint(endpoint)}")
+    await runner.scheduler.close()
+    latencies.sort()
+    return {
+        "elapsed_seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_latency": latencies[len(latencies) // 2],
+        "p95_latency": latencies[int(len(latencies) * 0.95)],
+        "retries": runner.scheduler.stats["retries"],
+        "per_endpoint": {endpoint.name: dict(endpoint.stats) for endpoint in runner.scheduler.endpoints},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Routing across two mock deployments")
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=50)
+    parser.add_argument("--primary-tpm", type=int, default=1000, help="quota of the first (fast) deployment")
+    parser.add_argument("--secondary-latency", type=float, default=0.2, help="latency of the second deployment")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    primary = start_mock_server(MockOptions(latency=0.05, reply_tokens=args.max_tokens, tpm=args.primary_tpm))
+    secondary = start_mock_server(MockOptions(latency=args.secondary_latency, reply_tokens=args.max_tokens))
+    endpoints = [
+        {"name": "primary", "endpoint": primary.url},
+        {"name": "secondary", "endpoint": secondary.url},
+    ]
+    results = {}
+    try:
+        for name, configured in (("single", endpoints[:1]), ("routed", endpoints)):
+            print(name)
+            results[name] = asyncio.run(run(configured, args.requests, args.concurrency, args.max_tokens))
+            print(f"  {results[name]['requests_per_second']:.2f} req/s, p95 {results[name]['p95_latency']:.2f} s, "
+                  f"{results[name]['retries']} retries")
+    finally:
+        primary.shutdown()
+        secondary.shutdown()
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
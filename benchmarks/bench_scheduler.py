@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from KizawaGPT import DEFAULT_SETTINGS, CompletionRunner, create_client
+from mock_server import MockOptions, start_mock_server
+
+# Sends many concurrent requests to a quota-limited mock deployment and compares
+# backoff alone with backoff plus the client-side token bucket.
+
+async def run(url, requests, concurrency, tpm, max_tokens):
+    settings = {
+        **DEFAULT_SETTINGS,
+        "AZURE_OPENAI_KEY": "mock",
+        "AZURE_OPENAI_ENDPOINT": url,
+        "DEPLOYMENT_NAME": "mock",
+        "MAX_TOKENS": max_tokens,
+        "MAX_CONTINUATIONS": 0,
+        "MAX_RETRIES": 20,
+        "RESPONSE_CACHE": False,
+        "TPM_QUOTA": tpm,
+    }
+    client = create_client(settings)
+    runner = CompletionRunner(settings, client)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(index):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await runner.complete([{"role": "user", "content": f"benchmark request {index}"}], False, [])
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    await client.close()
+    latencies.sort()
+    return {
+        "elapsed_seconds": elapsed,
+        "completed": len(latencies),
+        "failed": failures,
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+        "p95_latency": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        "client_retries": runner.scheduler.stats["retries"],
+        "client_queued_seconds": runner.scheduler.stats["queued_seconds"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Request scheduler throughput under contention")
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--tpm", type=int, default=6000, help="quota enforced by the mock deployment")
+    parser.add_argument("--max-tokens", type=int, default=100)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, client_tpm in (("backoff_only", 0), ("token_bucket", args.tpm)):
+        server = start_mock_server(MockOptions(reply_tokens=args.max_tokens, tpm=args.tpm))
+        result = asyncio.run(run(server.url, args.requests, args.concurrency, client_tpm, args.max_tokens))
+        result["server_429s"] = server.counters["throttled"]
+        server.shutdown()
+        results[name] = result
+        print(f"{name}: {result['completed']} ok, {result['failed']} failed, "
+              f"{result['requests_per_second']:.2f} req/s, {result['server_429s']} x 429")
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
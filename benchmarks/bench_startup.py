@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Cold-start time of the app, each run in a fresh interpreter: module import, window shown (interactive)
+# and API client ready. --app-folder points at another checkout (e.g. an older commit) to compare.
+
+PROBE = r'''
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import KizawaGPT
+result = {"import_ms": (time.perf_counter() - started) * 1000}
+try:
+    import tkinter as tk
+    root = tk.Tk()
+except Exception as e:
+    result["skipped"] = f"Tk is not available: {e}"
+    print(json.dumps(result))
+    sys.exit()
+settings = {**KizawaGPT.DEFAULT_SETTINGS, "HISTORY_FOLDER": sys.argv[2], "METRICS_LOG": "", "RESPONSE_CACHE": False}
+app = KizawaGPT.ChatApp(root, settings)
+root.update()
+result["window_ms"] = (time.perf_counter() - started) * 1000
+ready = getattr(app.engine, "ready", None)
+if ready is not None:
+    while not ready.wait(0.005):
+        root.update()
+result["client_ms"] = (time.perf_counter() - started) * 1000
+print(json.dumps(result))
+app.on_closing()
+'''
+
+def measure(app_folder, runs):
+    folder = tempfile.mkdtemp(prefix="kizawagpt_bench_")
+    samples = []
+    try:
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", PROBE, app_folder, folder], cwd=folder,
+                capture_output=True, text=True, check=True
+            ).stdout
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    result = {}
+    for key in ("import_ms", "window_ms", "client_ms"):
+        values = sorted(sample[key] for sample in samples if key in sample)
+        if values:
+            result[key] = {"mean": sum(values) / len(values), "p50": values[len(values) // 2], "max": values[-1]}
+    if "skipped" in samples[0]:
+        result["skipped"] = samples[0]["skipped"]
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--app-folder", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="folder containing the KizawaGPT.py to measure")
+    parser.add_argument("--baseline-folder", help="another checkout to measure for comparison")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    results = {"current": measure(os.path.abspath(args.app_folder), args.runs)}
+    if args.baseline_folder:
+        results["baseline"] = measure(os.path.abspath(args.baseline_folder), args.runs)
+    for name, result in results.items():
+        print(name)
+        for key, value in result.items():
+            if isinstance(value, dict):
+                print(f"  {key}: mean {value['mean']:.1f} ms, p50 {value['p50']:.1f} ms, max {value['max']:.1f} ms")
+            else:
+                print(f"  {key}: {value}")
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import argparse
+import collections
+import hashlib
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A local stand-in for an Azure OpenAI chat deployment, so benchmarks do not spend real quota.
+# It answers POST /openai/deployments/<name>/chat/completions, with or without streaming,
+# and enforces a TPM/RPM quota the way Azure does (429 + Retry-After, x-ratelimit-* headers).
+# Prompt caching is simulated per message: the longest run of leading messages seen before is
+# reported as usage.prompt_tokens_details.cached_tokens.
+
+CONTINUATION_PREFIX = "続きをお願いします"
+
+class MockOptions:
+    def __init__(self, latency=0.05, tokens_per_second=500.0, reply_tokens=100, tpm=0, rpm=0,
+                 chunk_tokens=1, inject_429_every=0, truncate_at=0, connect_latency=0.0, fail_status=0):
+        self.latency = latency                      # seconds before the first byte
+        self.tokens_per_second = tokens_per_second  # generation speed, 0 = instant
+        self.reply_tokens = reply_tokens            # length of a full answer
+        self.tpm = tpm                              # tokens per minute, 0 = unlimited
+        self.rpm = rpm                              # requests per minute, 0 = unlimited
+        self.chunk_tokens = chunk_tokens            # tokens per streamed chunk
+        self.inject_429_every = inject_429_every    # answer every Nth request with 429, 0 = never
+        self.truncate_at = truncate_at              # cut first answers at N tokens (finish_reason "length"), 0 = never
+        self.connect_latency = connect_latency      # extra seconds per new connection (DNS/TCP/TLS of a real endpoint)
+        self.fail_status = fail_status              # answer every request with this status (e.g. 401, 404), 0 = never
+
+class Quota:
+    WINDOW = 60.0
+
+    def __init__(self, tpm, rpm):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.usage = collections.deque()
+        self.lock = threading.Lock()
+
+    def admit(self, tokens):
+        # Returns (retry_after, remaining_tokens, remaining_requests); retry_after is None when admitted
+        now = time.monotonic()
+        with self.lock:
+            while self.usage and now - self.usage[0][0] >= self.WINDOW:
+                self.usage.popleft()
+            used_tokens = sum(t for _, t in self.usage)
+            over_tokens = self.tpm and used_tokens + tokens > self.tpm
+            over_requests = self.rpm and len(self.usage) + 1 > self.rpm
+            if over_tokens or over_requests:
+                retry_after = self.WINDOW - (now - self.usage[0][0]) if self.usage else 1.0
+                return max(retry_after, 0.1), 0, 0
+            self.usage.append((now, tokens))
+            remaining_tokens = self.tpm - used_tokens - tokens if self.tpm else None
+            remaining_requests = self.rpm - len(self.usage) if self.rpm else None
+            return None, remaining_tokens, remaining_requests
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.count("connections")
+        if self.server.options.connect_latency:
+            time.sleep(self.server.options.connect_latency)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.do_HEAD()
+
+    def do_POST(self):
+        options = self.server.options
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        number = self.server.count("requests")
+
+        if options.fail_status:
+            self.server.count("failed")
+            self.send_json(options.fail_status, {"error": {"code": str(options.fail_status), "message": "Injected failure."}}, {})
+            return
+
+        if options.inject_429_every and number % options.inject_429_every == 0:
+            self.server.count("throttled")
+            self.send_json(429, {"error": {"code": "429", "message": "Injected rate limit."}}, {"Retry-After": "0.2"})
+            return
+
+        message_tokens = [len(m["content"]) // 4 + 4 for m in body["messages"]]
+        prompt_tokens = sum(message_tokens)
+        max_tokens = body.get("max_tokens") or options.reply_tokens
+        retry_after, remaining_tokens, remaining_requests = self.server.quota.admit(prompt_tokens + max_tokens)
+        if retry_after is not None:
+            self.server.count("throttled")
+            self.send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                           {"Retry-After": f"{retry_after:.2f}", "retry-after-ms": str(int(retry_after * 1000))})
+            return
+
+        headers = {}
+        if remaining_tokens is not None:
+            headers["x-ratelimit-remaining-tokens"] = str(remaining_tokens)
+        if remaining_requests is not None:
+            headers["x-ratelimit-remaining-requests"] = str(remaining_requests)
+
+        reply_tokens = options.reply_tokens
+        continuation = body["messages"][-1]["content"].startswith(CONTINUATION_PREFIX)
+        if options.truncate_at and not continuation:
+            # Simulate a reply cut off by the deployment; the continuation request then finishes it
+            reply_tokens = min(reply_tokens, options.truncate_at)
+            max_tokens = min(max_tokens, reply_tokens)
+            truncated = True
+        else:
+            truncated = False
+        completion_tokens = min(reply_tokens, max_tokens)
+        finish_reason = "length" if truncated or completion_tokens < options.reply_tokens else "stop"
+        words = [f"token{i} " for i in range(completion_tokens)]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": self.server.cached_prefix(body["messages"], message_tokens)}}
+        time.sleep(options.latency)
+
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self.stream(words, finish_reason, headers, usage if include_usage else None)
+        else:
+            if options.tokens_per_second:
+                time.sleep(completion_tokens / options.tokens_per_second)
+            self.send_json(200, {
+                "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": "mock",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                             "finish_reason": finish_reason}],
+                "usage": usage,
+            }, headers)
+        self.server.count("completed")
+
+    def send_json(self, status, payload, headers):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, words, finish_reason, headers, usage=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        options = self.server.options
+        size = max(options.chunk_tokens, 1)
+        delay = size / options.tokens_per_second if options.tokens_per_second else 0
+        # Azure sends a first chunk without choices (prompt filter results)
+        self.send_event({"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": "mock", "choices": []})
+        for start in range(0, len(words), size):
+            if delay:
+                time.sleep(delay)
+            self.send_event(self.chunk({"content": "".join(words[start:start + size])}, None))
+        self.send_event(self.chunk({}, finish_reason))
+        if usage:
+            self.send_event({"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": "mock",
+                             "choices": [], "usage": usage})
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def chunk(self, delta, finish_reason):
+        return {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": "mock",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    def send_event(self, payload):
+        self.send_chunk(b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n")
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, MockHandler)
+        self.options = options
+        self.quota = Quota(options.tpm, options.rpm)
+        self.counters = collections.Counter()
+        self.counter_lock = threading.Lock()
+        self.prefixes = set()
+
+    def count(self, name):
+        with self.counter_lock:
+            self.counters[name] += 1
+            return self.counters[name]
+
+    def cached_prefix(self, messages, message_tokens):
+        digest = hashlib.sha256()
+        cached = 0
+        tokens = 0
+        with self.counter_lock:
+            for message, count in zip(messages, message_tokens):
+                digest.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+                key = digest.hexdigest()
+                tokens += count
+                if key in self.prefixes and cached == tokens - count:
+                    cached = tokens
+                self.prefixes.add(key)
+        return cached
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+def start_mock_server(options=None, port=0):
+    server = MockServer(("127.0.0.1", port), options or MockOptions())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Azure OpenAI server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--reply-tokens", type=int, default=100)
+    parser.add_argument("--tpm", type=int, default=0)
+    parser.add_argument("--rpm", type=int, default=0)
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--inject-429-every", type=int, default=0)
+    parser.add_argument("--truncate-at", type=int, default=0)
+    parser.add_argument("--connect-latency", type=float, default=0.0)
+    parser.add_argument("--fail-status", type=int, default=0)
+    args = parser.parse_args()
+
+    options = MockOptions(args.latency, args.tokens_per_second, args.reply_tokens, args.tpm, args.rpm,
+                          args.chunk_tokens, args.inject_429_every, args.truncate_at, args.connect_latency,
+                          args.fail_status)
+    server = MockServer(("127.0.0.1", args.port), options)
+    print(f"Mock Azure OpenAI: {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
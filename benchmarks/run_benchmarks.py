@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import KizawaGPT
+from KizawaGPT import DEFAULT_SETTINGS, CompletionRunner, ConversationStore, create_client
+from mock_server import MockOptions, start_mock_server
+
+# Benchmark suite run against the local mock deployment (no real quota is used).
+# Results are written as JSON; pass --baseline with an earlier result file to see the change per metric.
+
+def mock_settings(url, **overrides):
+    return {
+        **DEFAULT_SETTINGS,
+        "AZURE_OPENAI_KEY": "mock",
+        "AZURE_OPENAI_ENDPOINT": url,
+        "DEPLOYMENT_NAME": "mock",
+        "RESPONSE_CACHE": False,
+        # Mock turns must not end up in the app's real metrics.jsonl
+        "METRICS_LOG": "",
+        "STREAM_INCLUDE_USAGE": True,
+        **overrides,
+    }
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return {
+        "mean": sum(samples) / len(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[min(int(len(samples) * 0.95), len(samples) - 1)],
+        "max": samples[-1],
+    }
+
+async def measure_turns(settings, turns):
+    # Time to first token and end-to-end latency of consecutive turns in one conversation
+    client = create_client(settings)
+    first_token = []
+    total = []
+    prompt_tokens = 0
+    cached_tokens = 0
+    runner = CompletionRunner(settings, client, on_delta=lambda delta: first_token_at.append(time.perf_counter()))
+    history = [{"role": "system", "content": "You are a helpful assistant."}]
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"benchmark turn {turn}"})
+        first_token_at = []
+        reply = []
+        started = time.perf_counter()
+        result = await runner.complete(history, True, reply)
+        finished = time.perf_counter()
+        prompt_tokens += result["usage"]["prompt_tokens"]
+        cached_tokens += result["usage"]["cached_tokens"]
+        history.append({"role": "assistant", "content": "".join(reply)})
+        if first_token_at:
+            first_token.append(first_token_at[0] - started)
+        total.append(finished - started)
+    await client.close()
+    return {"time_to_first_token": summarize(first_token), "turn_latency": summarize(total),
+            "retries": runner.scheduler.stats["retries"],
+            "cached_prompt_share": cached_tokens / prompt_tokens if prompt_tokens else 0}
+
+def bench_requests(options, turns, **settings_overrides):
+    server = start_mock_server(options)
+    try:
+        result = asyncio.run(measure_turns(mock_settings(server.url, **settings_overrides), turns))
+        result["server_requests"] = server.counters["requests"]
+    finally:
+        server.shutdown()
+    return result
+
+def bench_history(sizes, message_chars):
+    # Append and reload cost of the conversation store as a conversation grows
+    folder = tempfile.mkdtemp(prefix="kizawagpt_bench_")
+    results = []
+    try:
+        text = ("会話履歴のベンチマーク用メッセージです。" * message_chars)[:message_chars]
+        for size in sizes:
+            store = ConversationStore(folder, 5)
+            conversation_id = f"bench_{size}"
+            appends = []
+            for index in range(size):
+                started = time.perf_counter()
+                store.append(conversation_id, [{"role": "user" if index % 2 == 0 else "assistant", "content": text}])
+                appends.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            store.sync()
+            sync_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            messages = store.load(conversation_id)
+            load_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            store.export_markdown(conversation_id, os.path.join(folder, f"{conversation_id}.md"))
+            export_seconds = time.perf_counter() - started
+            store.close()
+            assert len(messages) == size
+            results.append({
+                "messages": size,
+                "append_ms": summarize([a * 1000 for a in appends]),
+                "fsync_ms": sync_seconds * 1000,
+                "load_ms": load_seconds * 1000,
+                "export_markdown_ms": export_seconds * 1000,
+            })
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+def bench_ui(options, turns):
+    # Longest stall of the Tk main loop while replies stream in; needs a display
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+    except Exception as e:
+        return {"skipped": f"Tk is not available: {e}"}
+
+    server = start_mock_server(options)
+    folder = tempfile.mkdtemp(prefix="kizawagpt_bench_")
+    app = None
+    try:
+        app = KizawaGPT.ChatApp(root, mock_settings(server.url, HISTORY_FOLDER=folder))
+        interval = 0.005
+        gaps = []
+        last = [time.perf_counter()]
+
+        def heartbeat():
+            now = time.perf_counter()
+            gaps.append(now - last[0] - interval)
+            last[0] = now
+            root.after(int(interval * 1000), heartbeat)
+
+        root.after(int(interval * 1000), heartbeat)
+        started = time.perf_counter()
+        for turn in range(turns):
+            app.input_field.insert("1.0", f"benchmark turn {turn}")
+            app.send_message()
+            while app.session.is_processing:
+                root.update()
+        elapsed = time.perf_counter() - started
+        blocked = [gap for gap in gaps if gap > 0.016]
+        return {
+            "turns": turns,
+            "elapsed_seconds": elapsed,
+            "max_stall_ms": max(gaps) * 1000 if gaps else 0,
+            "stalls_over_16ms": len(blocked),
+            "blocked_ms": sum(blocked) * 1000,
+        }
+    finally:
+        if app:
+            app.engine.shutdown()
+            app.persistence.submit(app.store.close)
+            app.persistence.submit(app.search_index.close)
+            app.persistence.close(app.settings["PERSIST_FLUSH_SECONDS"])
+        root.destroy()
+        server.shutdown()
+        shutil.rmtree(folder, ignore_errors=True)
+
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flatten(f"{prefix}.{key}" if prefix else key, item, out)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            flatten(f"{prefix}[{index}]", item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+def compare(baseline, results):
+    old = flatten("", baseline["results"], {})
+    new = flatten("", results["results"], {})
+    for key in sorted(new):
+        if key in old and old[key]:
+            change = (new[key] - old[key]) / old[key] * 100
+            print(f"{key}: {old[key]:.4g} -> {new[key]:.4g} ({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="KizawaGPT benchmark suite")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.1, help="mock latency before the first byte")
+    parser.add_argument("--tokens-per-second", type=float, default=300.0)
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--history-sizes", default="10,100,1000,10000")
+    parser.add_argument("--message-chars", type=int, default=500)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    def options(**overrides):
+        values = dict(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                      reply_tokens=args.reply_tokens, chunk_tokens=args.chunk_tokens)
+        values.update(overrides)
+        return MockOptions(**values)
+
+    results = {}
+    print("streaming turns...")
+    results["turn"] = bench_requests(options(), args.turns)
+    print("continuation turns...")
+    results["continuation"] = bench_requests(options(truncate_at=args.reply_tokens // 2), args.turns)
+    print("turns with injected 429s...")
+    results["rate_limited"] = bench_requests(options(inject_429_every=3), args.turns)
+    print("turns with a trimmed history...")
+    results["trimmed_history"] = bench_requests(options(), args.turns * 3, CONTEXT_TOKEN_BUDGET=2000)
+    print("history store...")
+    results["history"] = bench_history([int(n) for n in args.history_sizes.split(",")], args.message_chars)
+    print("UI thread...")
+    results["ui"] = bench_ui(options(), min(args.turns, 5))
+
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "arguments": vars(args),
+        "results": results,
+    }
+    with open(args.output, 'w', encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
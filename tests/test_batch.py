@@ -0,0 +1,71 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from KizawaGPT import DEFAULT_SETTINGS, BatchRunner, ConversationStore
+from mock_server import MockOptions, start_mock_server
+
+# Run with: python -m unittest discover tests
+
+class BatchRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_mock_server(MockOptions(latency=0.01, reply_tokens=5))
+        self.folder = tempfile.mkdtemp(prefix="kizawagpt_test_")
+        self.prompts = os.path.join(self.folder, "prompts")
+        os.makedirs(self.prompts)
+        self.settings = {
+            **DEFAULT_SETTINGS,
+            "AZURE_OPENAI_KEY": "mock",
+            "AZURE_OPENAI_ENDPOINT": self.server.url,
+            "DEPLOYMENT_NAME": "mock",
+            "RESPONSE_CACHE": False,
+            "HISTORY_FOLDER": os.path.join(self.folder, "history"),
+        }
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_unreadable_prompt_is_recorded_as_error(self):
+        with open(os.path.join(self.prompts, "a.txt"), 'w', encoding="utf-8") as f:
+            f.write("こんにちは")
+        with open(os.path.join(self.prompts, "b.txt"), 'wb') as f:
+            f.write("こんにちは".encode("shift_jis"))
+        output = os.path.join(self.folder, "results.jsonl")
+        runner = BatchRunner(self.settings, self.prompts, 2, output)
+        self.assertEqual(asyncio.run(runner.run()), 1)
+
+        with open(output, 'r', encoding="utf-8") as f:
+            records = {record["prompt_file"]: record for record in map(json.loads, f)}
+        self.assertNotIn("error", records["a.txt"])
+        self.assertIn("error", records["b.txt"])
+        # The store was closed, so the saved conversation reads back from a fresh store
+        store = ConversationStore(self.settings["HISTORY_FOLDER"], 60)
+        self.assertEqual(store.load(records["a.txt"]["conversation"])[1]["content"], "こんにちは")
+        self.assertEqual(runner.store.files, {})
+
+    def test_similar_names_get_their_own_conversation(self):
+        # Stems alike in their first 30 characters, and the same stem with another extension
+        names = [f"customer_feedback_summary_2024_q{index}.txt" for index in range(4)] + ["a.txt", "a.md"]
+        for name in names:
+            with open(os.path.join(self.prompts, name), 'w', encoding="utf-8") as f:
+                f.write(name)
+        output = os.path.join(self.folder, "results.jsonl")
+        self.assertEqual(asyncio.run(BatchRunner(self.settings, self.prompts, 4, output).run()), 0)
+
+        with open(output, 'r', encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len({record["conversation"] for record in records}), len(names))
+        store = ConversationStore(self.settings["HISTORY_FOLDER"], 60)
+        for record in records:
+            self.assertEqual(store.load(record["conversation"])[1]["content"], record["prompt_file"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from KizawaGPT import ContextWindow, TokenCounter
+
+# Run with: python -m unittest discover tests
+
+class CharCounter(TokenCounter):
+    # One token per character, so budgets in the tests do not depend on tiktoken being installed
+    def __init__(self):
+        super().__init__()
+        self.counted = 0
+
+    def count_text(self, text):
+        self.counted += 1
+        return len(text)
+
+def conversation(count, chars=51):
+    # With the per-message overhead each message is chars + 4 tokens
+    messages = [{"role": "system", "content": "system"}]
+    for index in range(count):
+        text = f"{index:04d} " + "x" * (chars - 5)
+        messages.append({"role": "user" if index % 2 == 0 else "assistant", "content": text})
+    return messages
+
+class ContextWindowTest(unittest.TestCase):
+    def test_under_budget_sends_everything(self):
+        messages = conversation(10)
+        fitted, stats = ContextWindow(CharCounter(), 10000).fit(messages)
+        self.assertEqual(fitted, messages)
+        self.assertEqual(stats["dropped"], 0)
+        self.assertEqual(stats["sent_tokens"], stats["total_tokens"])
+
+    def test_trims_to_budget(self):
+        messages = conversation(200)
+        fitted, stats = ContextWindow(CharCounter(), 2000).fit(messages)
+        self.assertLessEqual(stats["sent_tokens"], 2000)
+        self.assertEqual(fitted[0], messages[0])
+        self.assertEqual(fitted[1]["role"], "system")
+        self.assertIn(f"{stats['dropped']} 件", fitted[1]["content"])
+        self.assertEqual(fitted[2:], messages[1 + stats["dropped"]:])
+        self.assertEqual(stats["dropped"] % ContextWindow.TRIM_STEP, 0)
+
+    def test_latest_message_is_always_sent(self):
+        messages = conversation(5) + [{"role": "user", "content": "y" * 5000}]
+        fitted, stats = ContextWindow(CharCounter(), 1000).fit(messages)
+        self.assertIs(fitted[-1], messages[-1])
+        self.assertEqual(stats["dropped"], 5)
+
+    def test_small_budget_keeps_what_fits(self):
+        # Only about three 55-token messages fit: step rounding would send the latest one alone
+        fitted, stats = ContextWindow(CharCounter(), 200).fit(conversation(20))
+        self.assertGreater(len(fitted), 3)
+        self.assertLessEqual(stats["sent_tokens"], 200)
+
+    def test_start_is_stable_across_turns(self):
+        window = ContextWindow(CharCounter(), 2000)
+        messages = conversation(200)
+        starts = []
+        for turn in range(6):
+            messages = messages + conversation(2)[1:]
+            starts.append(window.fit(messages)[1]["dropped"])
+        # The kept history starts at the same message for several turns, moving in TRIM_STEP jumps
+        self.assertLess(len(set(starts)), len(starts))
+        self.assertTrue(all(start % ContextWindow.TRIM_STEP == 0 for start in starts))
+        self.assertEqual(starts, sorted(starts))
+
+    def test_prewarmed_fit_is_reused_on_send(self):
+        counter = CharCounter()
+        window = ContextWindow(counter, 2000)
+        history = conversation(200)
+        prewarmed = window.fit(history + [{"role": "user", "content": "draft question"}])
+        counted = counter.counted
+        # On send the last message is a new object with the same text
+        sent = window.fit(history + [{"role": "user", "content": "draft question"}])
+        self.assertIs(sent, prewarmed)
+        self.assertEqual(counter.counted, counted)
+        edited = window.fit(history + [{"role": "user", "content": "draft question, edited"}])
+        self.assertIsNot(edited, prewarmed)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from KizawaGPT import ChatRenderer
+
+# Run with: python -m unittest discover tests
+
+class StubText:
+    # Enough of a ScrolledText for ChatRenderer: keeps the text, ignores marks and scrolling
+    def __init__(self):
+        self.text = ""
+        self.vbar = types.SimpleNamespace(set=lambda first, last: None)
+
+    def insert(self, index, text):
+        self.text = text + self.text if index == "1.0" else self.text + text
+
+    def yview(self, *args):
+        return (0.0, 1.0)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class StreamingTest(unittest.TestCase):
+    def test_message_during_stream_is_shown_after_the_reply(self):
+        # e.g. a load error reported to the selected tab while its reply is still streaming
+        renderer = ChatRenderer(StubText(), 100, 10)
+        renderer.begin("assistant")
+        renderer.append("AI: part one ")
+        renderer.redraw()
+        status = renderer.add("system", "最新の会話ファイルが見つかりません。\n")
+        renderer.append("part two")
+        renderer.end_message("\n")
+        renderer.redraw()
+
+        reply = renderer.records[0]
+        self.assertIs(renderer.finished, reply)
+        self.assertEqual("".join(reply.parts), "AI: part one part two\n")
+        self.assertIs(renderer.records[1], status)
+        text = renderer.widget.text
+        self.assertLess(text.index("part two"), text.index("最新の会話ファイル"))
+
+        message = object()
+        renderer.link(renderer.finished, message, "AI: ")
+        self.assertIs(reply.message, message)
+        self.assertIsNone(status.message)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import email.utils
+import os
+import sys
+import types
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import KizawaGPT
+from KizawaGPT import DEFAULT_SETTINGS, CompletionRunner, RequestScheduler, create_client
+from mock_server import MockOptions, start_mock_server
+
+# Run with: python -m unittest discover tests
+
+def mock_settings(endpoints):
+    return {
+        **DEFAULT_SETTINGS,
+        "AZURE_OPENAI_KEY": "mock",
+        "DEPLOYMENT_NAME": "mock",
+        "MAX_TOKENS": 10,
+        "MAX_CONTINUATIONS": 0,
+        "RESPONSE_CACHE": False,
+        "ENDPOINTS": endpoints,
+    }
+
+async def send(runner, count):
+    runner.scheduler.connect()
+    results = []
+    try:
+        for index in range(count):
+            try:
+                await runner.complete([{"role": "user", "content": f"request {index}"}], False, [])
+                results.append("ok")
+            except Exception as e:
+                results.append(type(e).__name__)
+    finally:
+        await runner.scheduler.close()
+    return results
+
+class FailoverTest(unittest.TestCase):
+    def setUp(self):
+        self.healthy = start_mock_server(MockOptions(latency=0.01, reply_tokens=10))
+        self.broken = start_mock_server(MockOptions(fail_status=404))
+
+    def tearDown(self):
+        self.healthy.shutdown()
+        self.broken.shutdown()
+
+    def test_broken_endpoint_fails_over(self):
+        # A wrong deployment name (404) pauses that endpoint; every request is served by the healthy one
+        runner = CompletionRunner(mock_settings([
+            {"name": "broken", "endpoint": self.broken.url},
+            {"name": "healthy", "endpoint": self.healthy.url},
+        ]))
+        results = asyncio.run(send(runner, 10))
+        self.assertEqual(results, ["ok"] * 10)
+        self.assertLessEqual(self.broken.counters["requests"], 1)
+        self.assertEqual(self.healthy.counters["completed"], 10)
+        broken = runner.scheduler.endpoints[0]
+        self.assertGreater(broken.score(0, broken.paused_until + 1), runner.scheduler.endpoints[1].score(0, 0))
+
+    def test_single_broken_endpoint_raises(self):
+        # Without another endpoint the error is not retried
+        runner = CompletionRunner(mock_settings([{"name": "broken", "endpoint": self.broken.url}]))
+        results = asyncio.run(send(runner, 1))
+        self.assertEqual(results, [KizawaGPT.openai.NotFoundError.__name__])
+        self.assertEqual(self.broken.counters["requests"], 1)
+
+async def rate_limited(url):
+    # The 429 error the mock answers with, headers and all
+    client = create_client({**mock_settings([]), "AZURE_OPENAI_ENDPOINT": url})
+    try:
+        for index in range(3):
+            await client.chat.completions.create(
+                model="mock", messages=[{"role": "user", "content": f"request {index}"}], max_tokens=10
+            )
+    except KizawaGPT.openai.RateLimitError as e:
+        return e
+    finally:
+        await client.close()
+
+def headers_error(headers):
+    return types.SimpleNamespace(response=types.SimpleNamespace(headers=headers))
+
+class RetryDelayTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = RequestScheduler(mock_settings([]), lambda key, text: None)
+
+    def test_retry_after_ms(self):
+        # The quota window is a minute, so the mock asks for most of it in both headers
+        server = start_mock_server(MockOptions(latency=0.0, reply_tokens=10, rpm=1))
+        try:
+            error = asyncio.run(rate_limited(server.url))
+        finally:
+            server.shutdown()
+        milliseconds = int(error.response.headers["retry-after-ms"])
+        delay = self.scheduler.retry_delay(error, 0)
+        self.assertGreaterEqual(delay, milliseconds / 1000)
+        self.assertLessEqual(delay, milliseconds / 1000 * 1.1)
+        # retry-after-ms wins over the rounded Retry-After
+        delay = self.scheduler.retry_delay(headers_error({"retry-after-ms": "1500", "retry-after": "9"}), 0)
+        self.assertTrue(1.5 <= delay <= 1.65, delay)
+
+    def test_numeric_retry_after(self):
+        server = start_mock_server(MockOptions(latency=0.0, reply_tokens=10, inject_429_every=1))
+        try:
+            error = asyncio.run(rate_limited(server.url))
+        finally:
+            server.shutdown()
+        self.assertEqual(error.response.headers["retry-after"], "0.2")
+        self.assertTrue(0.2 <= self.scheduler.retry_delay(error, 5) <= 0.22)
+
+    def test_http_date_retry_after(self):
+        date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+        delay = self.scheduler.retry_delay(headers_error({"retry-after": email.utils.format_datetime(date)}), 0)
+        # The date has whole seconds, so up to one second is lost to rounding
+        self.assertTrue(28 <= delay <= 33, delay)
+
+    def test_exponential_backoff_without_header(self):
+        for attempt in range(12):
+            limit = min(RequestScheduler.MAX_BACKOFF, 0.5 * 2 ** attempt)
+            for error in (headers_error({}), headers_error({"retry-after": "soon"}), ConnectionError()):
+                self.assertTrue(0 <= self.scheduler.retry_delay(error, attempt) <= limit)
+        # A Retry-After beyond the cap is cut to it
+        self.assertLessEqual(self.scheduler.retry_delay(headers_error({"retry-after": "3600"}), 0),
+                             RequestScheduler.MAX_BACKOFF * 1.1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from KizawaGPT import ConversationStore, iter_markdown, parse_markdown
+
+# Run with: python -m unittest discover tests
+
+def messages(*texts):
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": text} for index, text in enumerate(texts)]
+
+class CrashRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="kizawagpt_test_")
+        store = ConversationStore(self.folder, 60)
+        store.append("chat", messages("one", "two", "three"))
+        store.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def reopen_and_append(self):
+        # A later save reopens the files; the new message must land at the next position
+        store = ConversationStore(self.folder, 60)
+        store.append("chat", [{"role": "user", "content": "four"}])
+        self.assertEqual(store.count("chat"), 4)
+        self.assertEqual(store.read_messages("chat", [3, 2])[0]["content"], "four")
+        self.assertEqual([m["content"] for m in store.load("chat")], ["one", "two", "three", "four"])
+        store.close()
+
+    def test_torn_last_record(self):
+        with open(os.path.join(self.folder, "chat.jsonl"), 'ab') as f:
+            f.write(b'{"role": "user", "content": "fo')
+        store = ConversationStore(self.folder, 60)
+        self.assertEqual([m["content"] for m in store.load("chat")], ["one", "two", "three"])
+        self.reopen_and_append()
+
+    def test_index_behind_data(self):
+        with open(os.path.join(self.folder, "chat.idx"), 'r+b') as f:
+            f.truncate(ConversationStore.OFFSET.size + 3)
+        self.reopen_and_append()
+
+    def test_index_ahead_of_data(self):
+        with open(os.path.join(self.folder, "chat.idx"), 'ab') as f:
+            f.write(ConversationStore.OFFSET.pack(10 ** 6))
+        self.reopen_and_append()
+
+class MarkdownTest(unittest.TestCase):
+    def test_rules_inside_messages_survive(self):
+        conversation = [{"role": "system", "content": "prompt"}] + messages("a\n\n---\n\nb", "c")
+        text = "# 会話履歴 - chat\n\n" + "".join(iter_markdown(conversation))
+        self.assertEqual(parse_markdown(text), conversation)
+
+    def test_heading_before_each_save(self):
+        # Older versions appended a "# 会話履歴 - <time>" heading with every save
+        text = ("# 会話履歴 - 2024-01-01 10:00:00\n\n**あなた**: 質問1\n\n---\n\n**AI**: 回答1\n\n---\n\n"
+                "# 会話履歴 - 2024-01-01 10:01:00\n\n**あなた**: 質問2\n\n---\n\n**AI**: 回答2\n\n---\n\n")
+        self.assertEqual(parse_markdown(text), messages("質問1", "回答1", "質問2", "回答2"))
+
+if __name__ == "__main__":
+    unittest.main()